@@ -1,14 +1,27 @@
 from __future__ import annotations
 
+import threading
+from typing import Any
 from typing import Collection
 from typing import Dict
-from typing import List
+from typing import Hashable
+from typing import Iterable
+from typing import Optional
 from typing import Protocol
+from typing import Set
+from typing import Tuple
 from typing import TYPE_CHECKING
+from typing import Union
+from weakref import WeakKeyDictionary
 
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models import Field as ModelField
+from django.db.models import QuerySet
 from django.db.models.options import Options
 from rest_framework.fields import Field
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.serializers import BaseSerializer
+from rest_framework.serializers import ListSerializer
 from rest_framework.serializers import ModelSerializer
 
 if TYPE_CHECKING:
@@ -65,53 +78,308 @@ class SerializerOptInFieldsMixin:
             pass
         return []
 
-    def __init__(self: DRFSerializerProtocol, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def get_fields(self: DRFSerializerProtocol):
+        # only construct the fields that will be returned
+        keep_field = self._get_opt_in_field_filter()  # type:ignore[attr-defined]  # SerializerOptInFieldsMixin
+        self._declared_fields = {  # type:ignore[attr-defined]  # provided by SerializerMetaclass
+            name: field
+            for name, field in type(self)._declared_fields.items()  # type:ignore[attr-defined]
+            if keep_field(name)
+        }
+        fields = super().get_fields()  # type:ignore[misc]  # provided by Serializer
+        return {name: field for name, field in fields.items() if keep_field(name)}
 
-        if not hasattr(self, "context"):
-            # serializer invoked without context - inspection?
-            return
+    def get_field_names(self, declared_fields, info):
+        # ModelSerializer hook; avoids building model fields that will be excluded
+        keep_field = self._get_opt_in_field_filter()
+        return [name for name in super().get_field_names(declared_fields, info) if keep_field(name)]  # type:ignore[misc]
 
+    def _get_opt_in_field_filter(self: DRFSerializerProtocol):
+        """
+        Get a function that returns whether a field should be included
+        """
         pinned_fields = self.get_pinned_fields()
-
         fields_to_exclude = getattr(self.Meta, "opt_in_only_fields", [])
+        fields_to_include, opt_in_fields_to_include = self._get_requested_fields()  # type:ignore[attr-defined]
+
+        def keep_field(name: str) -> bool:
+            if name in pinned_fields or name in opt_in_fields_to_include:
+                return True
+            if fields_to_include:
+                return name in fields_to_include
+            return name not in fields_to_exclude
+
+        return keep_field
+
+    def _get_requested_fields(self: DRFSerializerProtocol) -> Tuple[Set[str], Set[str]]:
+        """
+        Parse include_fields & opt_in_fields from the request or context
+
+        This is only done once per serializer (get_fields() and get_field_names() both need it).
+
+        Only the context the serializer was created with (self._context) is used, not self.context: a nested
+        serializer declared on a parent (eg. `customer = CustomerSerializer()`) does not see the root request's
+        include_fields / opt_in_fields and returns its default fields unless it is given its own context
+        """
+        try:
+            return self._opt_in_requested_fields  # type:ignore[has-type]
+        except AttributeError:
+            pass
+        self._opt_in_requested_fields = _parse_requested_fields(self._context)  # type:ignore[attr-defined]
+        return self._opt_in_requested_fields
+
+
+def _parse_requested_fields(context: Dict[str, Any]) -> Tuple[Set[str], Set[str]]:
+    """
+    Get the (include_fields, opt_in_fields) requested thru the request query parameters or context
+    """
+    return (
+        _parse_field_list(_get_requested_field_param(context, "include_fields")),
+        _parse_field_list(_get_requested_field_param(context, "opt_in_fields")),
+    )
+
 
-        fields_to_include = (
-            (
-                "request" in self.context
-                and "include_fields" in self.context["request"].query_params
-                and self.context["request"].query_params["include_fields"]
-            )
-            or ("include_fields" in self.context and self.context["include_fields"])
-            or set(self.Meta.fields).difference(set(fields_to_exclude))
+def _get_requested_field_param(context: Dict[str, Any], name: str) -> Union[None, str, Iterable[str]]:
+    """
+    Get include_fields/opt_in_fields from the request query parameters, falling back to the context
+    """
+    request = context.get("request")
+    if request is not None:
+        query_params = request.query_params
+        if name in query_params:
+            value = query_params.getlist(name) if hasattr(query_params, "getlist") else query_params[name]
+            if not isinstance(value, str):
+                value = [item for item in value if item]
+            if value:
+                return value
+    return context.get(name) or None
+
+
+def _parse_field_list(value: Union[None, str, Iterable[str]]) -> Set[str]:
+    """
+    Turn a comma separated field list (or list of them) into a set of field names
+    """
+    if not value:
+        return set()
+    if isinstance(value, str):
+        value = [value]
+    return {name for item in value for name in item.split(",") if name}
+
+
+class SerializerOptInFieldsViewSetMixin:
+    """
+    ViewSet mixin that limits the queryset for read requests to the model fields & relations that the serializer
+    returns (eg. as narrowed by SerializerOptInFieldsMixin include_fields / opt_in_fields) using only(),
+    select_related() and prefetch_related()
+
+    only() is not applied if any field can't be mapped to a model field (eg. SerializerMethodField or a property)
+    or if the queryset already customises deferred fields, select_related() or prefetch_related(). Existing
+    select_related() lookups are kept (select_related() with no arguments is left as is)
+
+    The lookups are worked out once per serializer class & requested fields (see get_serializer_lookups_cache_key())
+    so the serializer isn't built an extra time for every request
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()  # type:ignore[misc]  # provided by GenericAPIView
+        request = getattr(self, "request", None)
+        if request is None or request.method not in ("GET", "HEAD"):
+            return queryset
+        if queryset._fields is not None:  # type:ignore[attr-defined]
+            return queryset
+
+        cache_key = self.get_serializer_lookups_cache_key()
+        if cache_key is None:
+            lookups = _get_serializer_lookups(queryset, self.get_serializer())  # type:ignore[attr-defined]
+        else:
+            cache_key = (queryset.model, frozenset(queryset.query.annotations), cache_key)
+            with _serializer_lookups_lock:
+                cache = _serializer_lookups_cache.setdefault(type(self), {})
+                is_cached = cache_key in cache
+                lookups = cache.get(cache_key)
+            if not is_cached:
+                lookups = _get_serializer_lookups(queryset, self.get_serializer())  # type:ignore[attr-defined]
+                with _serializer_lookups_lock:
+                    lookups = cache.setdefault(cache_key, lookups)
+        return _apply_serializer_lookups(queryset, lookups)
+
+    def get_serializer_lookups_cache_key(self) -> Optional[Hashable]:
+        """
+        Get the key the queryset lookups for the current request are cached under
+
+        The default is the serializer class plus the include_fields / opt_in_fields requested. Override this if the
+        fields a serializer returns depend on anything else (eg. the current user) or return None to disable caching
+        """
+        context = self.get_serializer_context()  # type:ignore[attr-defined]  # provided by GenericAPIView
+        include_fields, opt_in_fields = _parse_requested_fields(context)
+        return (
+            self.get_serializer_class(),  # type:ignore[attr-defined]
+            frozenset(include_fields),
+            frozenset(opt_in_fields),
         )
 
-        if isinstance(fields_to_include, str):
-            fields_to_include = [fields_to_include]
 
-        fields_to_include_list: List[str] = []
-        for f in fields_to_include:
-            if f.find(",") != -1:
-                fields_to_include_list += f.split(",")
+# queryset lookups for each SerializerOptInFieldsViewSetMixin class, keyed by (model, annotations, cache key)
+_serializer_lookups_lock = threading.RLock()
+_serializer_lookups_cache: "WeakKeyDictionary[type, Dict[Tuple[Any, ...], Optional[_QuerySetLookups]]]" = (
+    WeakKeyDictionary()
+)
+
+
+class _QuerySetLookups:
+    def __init__(self):
+        self.only: Set[str] = set()
+        self.select_related: Set[str] = set()
+        self.prefetch_related: Set[str] = set()
+        # whether only() can be used; False if the serializer may use fields we don't know about
+        self.can_defer = True
+
+
+def _get_serializer_lookups(queryset: QuerySet, serializer: BaseSerializer) -> Optional[_QuerySetLookups]:
+    """
+    Get the lookups needed for the fields a serializer will use or None if the serializer isn't for this queryset
+    """
+    if isinstance(serializer, ListSerializer):
+        serializer = serializer.child
+    model = getattr(getattr(serializer, "Meta", None), "model", None)
+    if model is None or not issubclass(queryset.model, model) or queryset._fields is not None:  # type:ignore[attr-defined]
+        return None
+
+    lookups = _QuerySetLookups()
+    _collect_serializer_lookups(serializer, queryset.model, "", lookups, False, queryset.query.annotations)
+    return lookups
+
+
+def _apply_serializer_lookups(queryset: QuerySet, lookups: Optional[_QuerySetLookups]) -> QuerySet:
+    """
+    Apply lookups from _get_serializer_lookups() to a queryset
+    """
+    if lookups is None:
+        return queryset
+    can_defer = (
+        lookups.can_defer
+        and queryset.query.deferred_loading == (frozenset(), True)
+        and queryset.query.select_related is False
+        and not queryset._prefetch_related_lookups  # type:ignore[attr-defined]
+        # GenericUserProfileQuerySet loads profiles with its own joins/queries
+        and not getattr(queryset, "_do_iterate_profiles", False)
+        and not getattr(queryset, "_do_resolve_profiles", False)
+    )
+    # select_related() with no arguments already follows every foreign key; passing lookups would replace that with
+    # just those lookups (if select_related() was given lookups then django merges them with ours)
+    if lookups.select_related and queryset.query.select_related is not True:
+        queryset = queryset.select_related(*sorted(lookups.select_related))
+    if lookups.prefetch_related:
+        queryset = queryset.prefetch_related(*sorted(lookups.prefetch_related))
+    if can_defer and lookups.only:
+        queryset = queryset.only(*sorted(lookups.only))
+    return queryset
+
+
+def _collect_serializer_lookups(
+    serializer: BaseSerializer,
+    model: type,
+    prefix: str,
+    lookups: _QuerySetLookups,
+    prefetching: bool,
+    annotations: Dict[str, Any],
+):
+    """
+    Record the only()/select_related()/prefetch_related() lookups needed by a (possibly nested) serializer
+
+    prefetching is True if the serializer is for records loaded with prefetch_related() (so only() doesn't apply)
+    """
+    for field in serializer.fields.values():  # type:ignore[attr-defined]
+        if field.write_only:
+            continue
+
+        if field.source == "*":
+            if isinstance(field, BaseSerializer):
+                _collect_serializer_lookups(field, model, prefix, lookups, prefetching, annotations)
             else:
-                fields_to_include_list.append(f)
-
-        opt_in_fields_to_include = (
-            (
-                "request" in self.context
-                and "opt_in_fields" in self.context["request"].query_params
-                and self.context["request"].query_params["opt_in_fields"]
-            )
-            or ("opt_in_fields" in self.context and self.context["opt_in_fields"])
-            or []
-        )
+                lookups.can_defer = False
+            continue
 
-        for f in list(self.fields.keys()):
-            if (
-                f not in pinned_fields
-                and f not in fields_to_include_list
-                and f not in opt_in_fields_to_include
-            ):
-                del self.fields[f]
+        name = field.source_attrs[0]
+        model_field = _get_model_field(model, name)
+        if model_field is None:
+            # a property or method could use any field
+            if name not in annotations:
+                lookups.can_defer = False
+            continue
+
+        if not model_field.is_relation or (model_field.concrete and name == model_field.attname != model_field.name):
+            # a plain column (or a foreign key's raw value)
+            if not prefetching:
+                lookups.only.add(prefix + model_field.name)
+            continue
+
+        # prefetch_related() uses the accessor name for reverse relations; select_related() & only() use the field name
+        lookup = prefix + name
+        nested = field.child if isinstance(field, ListSerializer) else field
+        related_model = model_field.related_model
+
+        if model_field.many_to_many or model_field.one_to_many:
+            lookups.prefetch_related.add(lookup)
+            if isinstance(nested, ModelSerializer):
+                _collect_serializer_lookups(nested, related_model, lookup + "__", lookups, True, {})
+            continue
+
+        if isinstance(field, PrimaryKeyRelatedField) and model_field.concrete and len(field.source_attrs) == 1:
+            # only needs the foreign key column
+            if not prefetching:
+                lookups.only.add(lookup)
+            continue
+
+        if related_model is None:
+            # GenericForeignKey; prefetch_related() needs its content type & object id columns
+            lookups.prefetch_related.add(lookup)
+            if not prefetching:
+                lookups.only.update(prefix + f for f in (model_field.ct_field, model_field.fk_field))
+            continue
+
+        if prefetching or not model_field.concrete:
+            # reverse one-to-one relations are prefetched rather than joined so we don't need to defer their fields
+            lookups.prefetch_related.add(lookup)
+            if isinstance(nested, ModelSerializer):
+                _collect_serializer_lookups(nested, related_model, lookup + "__", lookups, True, {})
+            continue
+
+        lookups.select_related.add(lookup)
+        lookups.only.add(lookup)
+        if isinstance(nested, ModelSerializer) and len(field.source_attrs) == 1:
+            _collect_serializer_lookups(nested, related_model, lookup + "__", lookups, False, {})
+        else:
+            # the related object is used some other way (eg. its __str__) so load all of its fields
+            lookups.only.update(lookup + "__" + f.name for f in related_model._meta.concrete_fields)
+
+
+def _get_model_field(model: type, name: str) -> Optional[Any]:
+    """
+    Get a model field by name, attname (eg. foreign key _id) or reverse relation accessor name
+    """
+    meta = model._meta  # type:ignore[attr-defined]
+    try:
+        return meta.get_field(name)
+    except FieldDoesNotExist:
+        pass
+    for related_object in meta.related_objects:
+        if related_object.get_accessor_name() == name:
+            return related_object
+    return None
+
+
+class PermissionQuerySetFilterMixin:
+    """
+    ViewSet mixin that narrows the queryset for list actions to the records the user has permission on
+
+    Applies filter_list_queryset() from each permission class that has one (eg. GenericDjangoViewsetPermissions);
+    these use the filters registered with allianceutils.auth.permission.register_perm_filter()
+    """
 
-        return
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)  # type:ignore[misc]  # provided by GenericAPIView
+        for permission in self.get_permissions():  # type:ignore[attr-defined]  # provided by APIView
+            if hasattr(permission, "filter_list_queryset"):
+                queryset = permission.filter_list_queryset(self.request, queryset, self)  # type:ignore[attr-defined]
+        return queryset
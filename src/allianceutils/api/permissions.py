@@ -1,6 +1,23 @@
+import random
+import threading
+from typing import Dict
+from typing import FrozenSet
+from typing import List
+from typing import Optional
+from typing import Tuple
+from weakref import WeakKeyDictionary
+
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from rest_framework.permissions import BasePermission
+from rest_framework.permissions import SAFE_METHODS
+
+from allianceutils.api.mixins import PermissionQuerySetFilterMixin
+from allianceutils.auth.permission import _timed_has_perm
+from allianceutils.auth.permission import _timed_has_perms
+from allianceutils.auth.permission import filter_queryset_by_perms
+from allianceutils.auth.permission import get_perm_filter
+from allianceutils.auth.permission import identify_global_perms
 
 
 class SimpleDjangoObjectPermissions(BasePermission):
@@ -15,15 +32,46 @@ class SimpleDjangoObjectPermissions(BasePermission):
 
     Also note that if you override get_object() then you need to manually invoke
     self.check_object_permissions(self.request, obj)
+
+    By default object checks evaluate both the global and object permission to make sure they're not both True.
+    consistency_check (or settings.SIMPLE_OBJECT_PERMISSIONS_CONSISTENCY_CHECK) controls when this happens:
+    - 'always': every check (default)
+    - 'debug': only when settings.DEBUG is True
+    - 'sample': a random consistency_check_sample_rate fraction of checks
+    - 'never'
+    Otherwise the permission type from identify_global_perms() is checked first and the check stops as soon as
+    one passes
     """
+    consistency_check: Optional[str] = None
+    consistency_check_sample_rate = 0.01
+
     def has_permission(self, request, view):
-        return request.user.has_perm(view.permission_required)
+        return _timed_has_perm(request.user, view.permission_required)
+
+    def should_check_consistency(self) -> bool:
+        mode = self.consistency_check or getattr(settings, 'SIMPLE_OBJECT_PERMISSIONS_CONSISTENCY_CHECK', 'always')
+        if mode == 'always':
+            return True
+        if mode == 'debug':
+            return settings.DEBUG
+        if mode == 'sample':
+            return random.random() < self.consistency_check_sample_rate
+        if mode == 'never':
+            return False
+        raise ImproperlyConfigured(f"Invalid SimpleDjangoObjectPermissions consistency_check {mode!r}")
 
     def has_object_permission(self, request, view, obj):
+        if not self.should_check_consistency():
+            perm = view.permission_required
+            global_perms, object_perms = identify_global_perms(perm)
+            if global_perms:
+                return _timed_has_perm(request.user, perm) or _timed_has_perm(request.user, perm, obj)
+            return _timed_has_perm(request.user, perm, obj) or _timed_has_perm(request.user, perm)
+
         # Note: this assertion may fail with django_rules as it will happily try to check the same predicate regardless
         # of whether obj is supplied or not, meaning that both calls below will return True.
-        has_perm_global = request.user.has_perm(view.permission_required)
-        has_perm_obj = request.user.has_perm(view.permission_required, obj)
+        has_perm_global = _timed_has_perm(request.user, view.permission_required)
+        has_perm_obj = _timed_has_perm(request.user, view.permission_required, obj)
         assert not (has_perm_global and has_perm_obj), (
             "Object level and global permissions shouldn't both return True. "
             "This may indicate a potential security issue with your permissions."
@@ -31,6 +79,19 @@ class SimpleDjangoObjectPermissions(BasePermission):
         return has_perm_global or has_perm_obj
 
 
+# guards population of _actions_to_perms_maps, _list_actions & _viewset_action_perms_cache
+_registry_lock = threading.RLock()
+
+# permission class -> merged actions to perms map
+_actions_to_perms_maps: "WeakKeyDictionary[type, Dict[str, List[str]]]" = WeakKeyDictionary()
+
+# viewset class -> {permission class: list actions}
+_list_actions: "WeakKeyDictionary[type, Dict[type, FrozenSet[str]]]" = WeakKeyDictionary()
+
+# viewset class -> {(permission class, action): permission codes}
+_viewset_action_perms_cache: "WeakKeyDictionary[type, Dict[Tuple[type, Optional[str]], List[str]]]" = WeakKeyDictionary()
+
+
 class GenericDjangoViewsetPermissions(BasePermission):
     """
     Map viewset actions to Django permissions.
@@ -42,8 +103,22 @@ class GenericDjangoViewsetPermissions(BasePermission):
         }
     then no permissions will be required for the create action, but permissions
     for other actions will remain unchanged.
+
+    If the viewset uses PermissionQuerySetFilterMixin then the actions in filtered_list_actions are also allowed
+    (for safe methods only) for users who only have object permissions with a filter registered using
+    register_perm_filter(); the queryset is narrowed to the records they have permission on.
+
+    If cache_permissions_for_action is set then the permission codes for each viewset class & action are only
+    calculated once (so get_model() and get_queryset() are not called on every request). Only enable this if
+    the permission model doesn't vary between requests.
     """
 
+    cache_permissions_for_action = False
+
+    # List actions whose queryset goes through filter_queryset() and so can be narrowed by
+    # PermissionQuerySetFilterMixin. Other list actions (eg. create) always require the global permissions.
+    filtered_list_actions = ('list',)
+
     # Maps actions to required permission strings. *All* strings must be present
     # to allow the action.
     default_actions_to_perms_map = {
@@ -62,9 +137,6 @@ class GenericDjangoViewsetPermissions(BasePermission):
         'create',
     )
 
-    def __init__(self):
-        self._saved_actions_to_perms_map = None
-
     def get_model(self, view):
         """Get the model to use for the permission check.
 
@@ -83,18 +155,48 @@ class GenericDjangoViewsetPermissions(BasePermission):
     def get_actions_to_perms_map(self):
         """
         Merge the default actions to perms map with the class overrides & return
-        Will cache results
+
+        The merged map is cached for each permission class, unless actions_to_perms_map has been set
+        on this instance
         """
-        if self._saved_actions_to_perms_map is None:
-            self._saved_actions_to_perms_map = self.default_actions_to_perms_map.copy()
-            self._saved_actions_to_perms_map.update(getattr(self, 'actions_to_perms_map', {}))
+        if 'actions_to_perms_map' in self.__dict__:
+            return self._merge_actions_to_perms_map()
+        cls = type(self)
+        try:
+            return _actions_to_perms_maps[cls]
+        except KeyError:
+            pass
+        with _registry_lock:
+            if cls not in _actions_to_perms_maps:
+                _actions_to_perms_maps[cls] = self._merge_actions_to_perms_map()
+            return _actions_to_perms_maps[cls]
 
-        return self._saved_actions_to_perms_map
+    def _merge_actions_to_perms_map(self):
+        perms_map = self.default_actions_to_perms_map.copy()
+        perms_map.update(getattr(self, 'actions_to_perms_map', {}))
+        return perms_map
 
     def get_permissions_for_action(self, action, view):
         """Given a model and an action, return the list of permission
-        codes that the user is required to have."""
+        codes that the user is required to have.
+
+        Results are cached per viewset class & action if cache_permissions_for_action is set (unless
+        actions_to_perms_map has been set on this instance)"""
+        if not self.cache_permissions_for_action or 'actions_to_perms_map' in self.__dict__:
+            return self._get_permissions_for_action(action, view)
 
+        key = (type(self), action)
+        try:
+            return list(_viewset_action_perms_cache[type(view)][key])
+        except KeyError:
+            pass
+        perms = self._get_permissions_for_action(action, view)
+        with _registry_lock:
+            viewset_perms = _viewset_action_perms_cache.setdefault(type(view), {})
+            perms = viewset_perms.setdefault(key, perms)
+        return list(perms)
+
+    def _get_permissions_for_action(self, action, view):
         model_cls = self.get_model(view)
         kwargs = {
             'app_label': model_cls._meta.app_label,
@@ -109,31 +211,43 @@ class GenericDjangoViewsetPermissions(BasePermission):
     def get_list_actions(self, viewset):
         """
         Get the list actions; these will not have get_object() invoked when checking permissions
-        """
-        viewset_class = viewset.__class__
-
-        # Is this really ok to be caching on this another object?
-        if not hasattr(viewset_class, '_saved_permission_list_actions'):
-            viewset_class._saved_permission_list_actions = set(self.default_list_routes)
-
-            # Determine any `@list_route` decorated methods on the viewset
-            for methodname in dir(viewset_class):
-                method = getattr(viewset_class, methodname)
 
-                # pre-3.9 DRF
-                http_methods = getattr(method, 'bind_to_methods', None)
-                # Only certain methods do not require an object
-                if http_methods and all(m.lower() in ('header', 'get', 'post',) for m in http_methods):
-                    if getattr(method, 'detail', None) is False:
-                        viewset_class._saved_permission_list_actions.add(methodname)
-
-                # post-3.9 DRF
-                if not http_methods and hasattr(method, 'mapping'):
-                    if all(m.lower() in ('header', 'get', 'post',) for m in getattr(method, 'mapping').keys()):
-                        if getattr(method, 'detail', None) is False: # the detail remains accessible - just bind_to_methods' gone.
-                            viewset_class._saved_permission_list_actions.add(methodname)
-
-        return viewset_class._saved_permission_list_actions
+        These are calculated once for each viewset class; use register_viewset_permissions() (or
+        ViewsetPermissionsRouterMixin) to calculate them in advance rather than on the first request.
+        As the result is shared it is returned as a frozenset.
+        """
+        viewset_class = viewset if isinstance(viewset, type) else type(viewset)
+        try:
+            return _list_actions[viewset_class][type(self)]
+        except KeyError:
+            pass
+        with _registry_lock:
+            viewset_list_actions = _list_actions.setdefault(viewset_class, {})
+            if type(self) not in viewset_list_actions:
+                viewset_list_actions[type(self)] = self._find_list_actions(viewset_class)
+            return viewset_list_actions[type(self)]
+
+    def _find_list_actions(self, viewset_class):
+        list_actions = set(self.default_list_routes)
+
+        # Determine any `@list_route` decorated methods on the viewset
+        for methodname in dir(viewset_class):
+            method = getattr(viewset_class, methodname)
+
+            # pre-3.9 DRF
+            http_methods = getattr(method, 'bind_to_methods', None)
+            # Only certain methods do not require an object
+            if http_methods and all(m.lower() in ('header', 'get', 'post',) for m in http_methods):
+                if getattr(method, 'detail', None) is False:
+                    list_actions.add(methodname)
+
+            # post-3.9 DRF
+            if not http_methods and hasattr(method, 'mapping'):
+                if all(m.lower() in ('header', 'get', 'post',) for m in getattr(method, 'mapping').keys()):
+                    if getattr(method, 'detail', None) is False: # the detail remains accessible - just bind_to_methods' gone.
+                        list_actions.add(methodname)
+
+        return frozenset(list_actions)
 
     def has_permission(self, request, viewset):
 
@@ -157,7 +271,7 @@ class GenericDjangoViewsetPermissions(BasePermission):
         perms = self.get_permissions_for_action(action, viewset)
 
         # Check permissions for action available irrespective of object
-        if user.has_perms(perms):
+        if _timed_has_perms(user, perms):
             return True
 
         # Action relates to object, check object level permission
@@ -167,8 +281,27 @@ class GenericDjangoViewsetPermissions(BasePermission):
             viewset.get_object()   # will raise an exception if permission denied
             return True
 
+        # Read-only list action; the queryset can be narrowed to the objects the user has permission on
+        if (
+            isinstance(viewset, PermissionQuerySetFilterMixin)
+            and action in self.filtered_list_actions
+            and request.method in SAFE_METHODS
+        ):
+            return all(get_perm_filter(perm) is not None or _timed_has_perm(user, perm) for perm in perms)
+
         return False
 
+    def filter_list_queryset(self, request, queryset, viewset):
+        """
+        Narrow the queryset for filtered_list_actions to the objects the user has the action permissions on.
+        Used by PermissionQuerySetFilterMixin
+        """
+        action = getattr(viewset, 'action', None)
+        if action not in self.filtered_list_actions:
+            return queryset
+        perms = self.get_permissions_for_action(action, viewset)
+        return filter_queryset_by_perms(request.user, perms, queryset)
+
     def has_object_permission(self, request, viewset, obj):
         action = viewset.action
         # Handles OPTIONS requests
@@ -176,4 +309,16 @@ class GenericDjangoViewsetPermissions(BasePermission):
             return True
         perms = self.get_permissions_for_action(action, viewset)
         user = request.user
-        return user.has_perms(perms, obj)
+        return _timed_has_perms(user, perms, obj)
+
+
+def register_viewset_permissions(viewset_class):
+    """
+    Calculate the list actions and actions to perms map for each GenericDjangoViewsetPermissions on a viewset
+    in advance rather than on its first request
+    """
+    for permission_class in getattr(viewset_class, 'permission_classes', ()):
+        if isinstance(permission_class, type) and issubclass(permission_class, GenericDjangoViewsetPermissions):
+            permission = permission_class()
+            permission.get_actions_to_perms_map()
+            permission.get_list_actions(viewset_class)
@@ -0,0 +1,17 @@
+from allianceutils.api.permissions import register_viewset_permissions
+
+
+class ViewsetPermissionsRouterMixin:
+    """
+    Router mixin that calculates GenericDjangoViewsetPermissions list actions & permission maps for each
+    viewset when it is registered rather than on its first request
+
+    Usage::
+
+        class Router(ViewsetPermissionsRouterMixin, DefaultRouter):
+            pass
+    """
+
+    def register(self, prefix, viewset, basename=None):
+        super().register(prefix, viewset, basename)  # type:ignore[misc]  # provided by BaseRouter
+        register_viewset_permissions(viewset)
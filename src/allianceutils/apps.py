@@ -8,3 +8,9 @@ __all__ = [
 class AllianceUtilsAppConfig(AppConfig):
     name = 'allianceutils'
     verbose_name = "Alliance Django Utils"
+
+    def ready(self):
+        from allianceutils.auth.backends import connect_profile_cache_signals
+        from allianceutils.auth.models import connect_profile_type_signals
+        connect_profile_cache_signals()
+        connect_profile_type_signals()
@@ -1,12 +1,28 @@
 from __future__ import annotations
 
+from functools import lru_cache
+from functools import partial
+from typing import Collection
+from typing import FrozenSet
 from typing import Optional
 from typing import Protocol
+import uuid
 
-from allianceutils.auth.models import GenericUserProfile
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_backends
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied
+from django.core.signals import setting_changed
+from django.db import transaction
 from django.db.models import Model
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from allianceutils.auth.models import _get_profile_models
+from allianceutils.auth.models import GenericUserProfile
 
 
 def resolve_perm_name(module, entity, action, is_global) -> str:
@@ -20,6 +36,9 @@ UserModel = get_user_model()
 
 
 class _BaseUserModelBackend(Protocol):
+    profile_cache_alias: Optional[str]
+    profile_cache_timeout: Optional[int]
+
     def get_user(self, user_id):
         ...
 
@@ -35,21 +54,159 @@ class ProfileModelBackendMixin:
     """
     Backend that provides authentication using User.profiles & get_profile().
     Will fall back to default get_user() behaviour if no profiles manager available
+
+    If profile_cache_alias is set then loaded profiles are stored in that cache; cached profiles are invalidated
+    whenever the user or any of its profile records are saved or deleted.
     """
 
+    # alias of the cache (in settings.CACHES) to store loaded profiles in; caching is disabled if None
+    profile_cache_alias: Optional[str] = None
+    profile_cache_timeout: Optional[int] = 300
+
     def get_user(self: _BaseUserModelBackend, user_id) -> Optional[GenericUserProfile]:
         try:
             manager = UserModel.profiles
         except AttributeError:
             return super().get_user(user_id)  # type: ignore[safe-super]
 
-        try:
-            user = manager.get(pk=user_id)
-        except UserModel.DoesNotExist:
-            return None
+        user = None
+        cache_key = None
+        if self.profile_cache_alias:
+            # the key is resolved before loading the profile so that an invalidation in the meantime is noticed
+            cache_key = _get_profile_cache_key(self.profile_cache_alias, user_id)
+            user = caches[self.profile_cache_alias].get(cache_key)
+
+        if user is None:
+            try:
+                user = manager.get(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            if self.profile_cache_alias:
+                set_cached_profile(self.profile_cache_alias, user, self.profile_cache_timeout, cache_key)
 
         return user if self.user_can_authenticate(user) else None
 
+    async def aget_user(self, user_id) -> Optional[GenericUserProfile]:
+        # django's ModelBackend.aget_user() would load a plain User record instead of the profile.
+        # (the ORM is synchronous anyway so we do all the work in a single thread hop)
+        return await sync_to_async(self.get_user)(user_id)
+
+
+PROFILE_CACHE_KEY_PREFIX = 'allianceutils.auth.profile'
+
+
+def _get_profile_cache_version_key(user_id) -> str:
+    return f'{PROFILE_CACHE_KEY_PREFIX}:{UserModel._meta.label_lower}:{user_id}'
+
+
+def _get_profile_cache_key(cache_alias: str, user_id, create: bool = True) -> Optional[str]:
+    """
+    Cache entries are keyed by user id plus a version stamp that changes whenever the profile is invalidated
+    so that a request that loaded a profile before it was changed can't overwrite the cache with stale data
+
+    If create is False then None is returned if there is no current version
+    """
+    cache = caches[cache_alias]
+    version_key = _get_profile_cache_version_key(user_id)
+    version = cache.get(version_key)
+    if version is None:
+        if not create:
+            return None
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, timeout=None):
+            # someone else created a version first
+            version = cache.get(version_key, version)
+    return f'{version_key}:{version}'
+
+
+def get_cached_profile(cache_alias: str, user_id) -> Optional[GenericUserProfile]:
+    """
+    Get a profile previously stored by set_cached_profile()
+    """
+    return caches[cache_alias].get(_get_profile_cache_key(cache_alias, user_id))
+
+
+def set_cached_profile(
+    cache_alias: str,
+    user: GenericUserProfile,
+    timeout: Optional[int],
+    cache_key: Optional[str] = None,
+):
+    """
+    Store a profile in the cache
+
+    This never creates a new version stamp: nothing is stored if the profile was invalidated (or was never looked up
+    with get_cached_profile()) since it may have been loaded before the invalidating change.
+
+    :param cache_key: the key the profile was looked up under before it was loaded from the database; if the profile
+        has been invalidated since then it is not stored
+    """
+    current_key = _get_profile_cache_key(cache_alias, user.pk, create=False)
+    if current_key is None or (cache_key is not None and cache_key != current_key):
+        return
+    caches[cache_alias].set(current_key, user, timeout=timeout)
+
+
+def invalidate_cached_profile(user_id, cache_alias: Optional[str] = None):
+    """
+    Invalidate any cached profile for a user
+
+    This is done automatically when a user or profile record is saved or deleted but you will need to call this
+    yourself after changes that bypass model signals (eg QuerySet.update())
+
+    :param user_id: The user's primary key
+    :param cache_alias: The cache to invalidate; defaults to the caches used by all configured ProfileModelBackendMixin backends
+    """
+    cache_aliases = {cache_alias} if cache_alias else _get_profile_cache_aliases()
+    for alias in cache_aliases:
+        caches[alias].delete(_get_profile_cache_version_key(user_id))
+
+
+@lru_cache(maxsize=None)
+def _get_profile_cache_aliases() -> FrozenSet[str]:
+    """
+    The caches used by all configured ProfileModelBackendMixin backends
+
+    get_backends() instantiates every backend so this is calculated once rather than on every save
+    """
+    return frozenset(
+        backend.profile_cache_alias
+        for backend in get_backends()
+        if isinstance(backend, ProfileModelBackendMixin) and backend.profile_cache_alias
+    )
+
+
+@receiver(setting_changed)
+def _clear_profile_cache_aliases_on_setting_changed(setting: str, **kwargs):
+    if setting == "AUTHENTICATION_BACKENDS":
+        _get_profile_cache_aliases.cache_clear()
+
+
+def _invalidate_cached_profile_receiver(sender, instance: Model, using: str, **kwargs):
+    cache_aliases = _get_profile_cache_aliases()
+    if not cache_aliases:
+        return
+    for alias in cache_aliases:
+        invalidate_cached_profile(instance.pk, alias)
+        # a concurrent request may have cached the profile as it was before this transaction was committed
+        transaction.on_commit(partial(invalidate_cached_profile, instance.pk, alias), using=using)
+
+
+def connect_profile_cache_signals():
+    """
+    Connect the signals that invalidate cached profiles; this is called by AllianceUtilsAppConfig.ready()
+    """
+    models = [UserModel]
+    if getattr(UserModel, 'related_profile_tables', None):
+        models += list(_get_profile_models(UserModel).values())
+    for model in models:
+        for signal in (post_save, post_delete):
+            signal.connect(
+                _invalidate_cached_profile_receiver,
+                sender=model,
+                dispatch_uid=f'{PROFILE_CACHE_KEY_PREFIX}:{model._meta.label_lower}',
+            )
+
 
 class MinimalModelBackend:
     """
@@ -64,6 +221,11 @@ class MinimalModelBackend:
     get_user = ModelBackend.get_user
     user_can_authenticate = ModelBackend.user_can_authenticate
 
+    # django >= 5.2 async API
+    if hasattr(ModelBackend, 'aget_user'):
+        aauthenticate = ModelBackend.aauthenticate
+        aget_user = ModelBackend.aget_user
+
     def has_perm(self, user: _BaseUserModel, perm: str, obj: Optional[Model] = None) -> bool:
         """
         We defer to other backends for the real logic
@@ -71,3 +233,92 @@ class MinimalModelBackend:
         if user.is_superuser:
             return True
         return False
+
+    async def ahas_perm(self, user: _BaseUserModel, perm: str, obj: Optional[Model] = None) -> bool:
+        return self.has_perm(user, perm, obj)
+
+
+class PermissionMatrixBackendMixin:
+    """
+    Answers global django-rules permission checks from a (user/profile model, permission) matrix that is
+    only calculated once rather than evaluating the rule each time; see
+    allianceutils.auth.permission.get_role_global_perm()
+
+    Each rule is evaluated against an unsaved instance of the user/profile model so only the permissions listed in
+    permission_matrix_perms are answered this way; list only rules that depend solely on the type of user
+    (eg. profile type) and not on any field values (eg. is_staff). Other permissions are passed on to the
+    remaining backends.
+    """
+
+    # global permissions that depend only on the type of user and so can be answered from the matrix
+    permission_matrix_perms: Collection[str] = frozenset()
+
+    # whether to raise PermissionDenied (so that no other backends are checked) if the matrix denies a permission
+    permission_matrix_denies = False
+
+    def has_perm(self, user: _BaseUserModel, perm: str, obj: Optional[Model] = None) -> bool:
+        # not imported at module level so that AllianceUtilsAppConfig.ready() doesn't pull in auth.permission
+        from allianceutils.auth.permission import get_role_global_perm
+
+        if obj is None and user.is_active and perm in self.permission_matrix_perms:
+            result = get_role_global_perm(type(user), perm)
+            if result:
+                return True
+            if result is False and self.permission_matrix_denies and not user.is_superuser:
+                raise PermissionDenied
+        return super().has_perm(user, perm, obj)  # type:ignore[misc]  # mixin
+
+
+class PermissionCacheBackend:
+    """
+    Backend that caches has_perm() results from the other backends inside a
+    allianceutils.auth.permission.permission_cache() block (see PermissionCacheMiddleware)
+
+    This must be the first entry in AUTHENTICATION_BACKENDS; outside of a permission_cache() block it does nothing
+    """
+
+    def authenticate(self, request, **credentials) -> None:
+        return None
+
+    def get_user(self, user_id) -> None:
+        return None
+
+    def has_perm(self, user: Model, perm: str, obj: Optional[Model] = None) -> bool:
+        # not imported at module level so that AllianceUtilsAppConfig.ready() doesn't pull in auth.permission
+        from allianceutils.auth.permission import _get_permission_cache
+        from allianceutils.auth.permission import _get_permission_cache_key
+        from allianceutils.auth.permission import _record_permission_cache
+
+        results = _get_permission_cache()
+        if results is None:
+            return False
+
+        key = _get_permission_cache_key(user, perm, obj)
+        try:
+            result = results[key]
+            _record_permission_cache(True)
+        except KeyError:
+            _record_permission_cache(False)
+            result = results[key] = self._has_perm(user, perm, obj)
+
+        # django stops at the first backend that returns True or raises PermissionDenied
+        if not result:
+            raise PermissionDenied
+        return True
+
+    async def ahas_perm(self, user: Model, perm: str, obj: Optional[Model] = None) -> bool:
+        return await sync_to_async(self.has_perm)(user, perm, obj)
+
+    def _has_perm(self, user: Model, perm: str, obj: Optional[Model]) -> bool:
+        """
+        Equivalent of django.contrib.auth.models._user_has_perm() for the remaining backends
+        """
+        for backend in get_backends():
+            if isinstance(backend, PermissionCacheBackend) or not hasattr(backend, "has_perm"):
+                continue
+            try:
+                if backend.has_perm(user, perm, obj):
+                    return True
+            except PermissionDenied:
+                return False
+        return False
@@ -1,24 +1,74 @@
 from __future__ import annotations
 
+from collections import defaultdict
+from itertools import islice
+import logging
+import os
+import traceback
+from typing import Any
+from typing import Dict
 from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import Type
 from typing import TypeVar
 from typing import Union
 from typing import cast
+import warnings
 
 from allianceutils.checks import ID_ERROR_PROFILE_RELATED_TABLES
+from allianceutils.middleware.query_count import QueryCounter
+import asgiref
+from asgiref.sync import sync_to_async
+import django
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import BaseUserManager
 from django.contrib.auth.models import UserManager
 from django.core import checks
+from django.core.exceptions import FieldDoesNotExist
+from django.core.exceptions import FieldError
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import CharField
+from django.db.models import Count
+from django.db.models import Exists
+from django.db.models import F
 from django.db.models import Model
+from django.db.models import OuterRef
+from django.db.models import Prefetch
+from django.db.models import Q
 from django.db.models import QuerySet
+from django.db.models import Value
+from django.db.models import When
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.functions import Cast
 from django.db.models.query import ModelIterable
+from django.db.models.signals import pre_save
 from typing_extensions import Self
 
 _ModelT = TypeVar("_ModelT", bound=Model, covariant=True)
 
+logger = logging.getLogger("allianceutils")
+
+
+class LazyProfileLoadWarning(RuntimeWarning):
+    """
+    A profile was loaded lazily with extra queries (see settings.GENERIC_USER_PROFILE_LAZY_LOAD)
+    """
+    pass
+
+
+class LazyProfileLoadError(RuntimeError):
+    """
+    A profile was loaded lazily with extra queries (see settings.GENERIC_USER_PROFILE_LAZY_LOAD)
+    """
+    pass
+
 
 class GenericUserProfileIterable(ModelIterable):
     """
@@ -28,14 +78,134 @@ class GenericUserProfileIterable(ModelIterable):
     queryset: GenericUserProfileQuerySet  # this is coupled to this QuerySet
 
     def __iter__(self) -> Iterable[Union[GenericUserProfile, _ModelT]]:  # type:ignore[override]  # specialised return
-        if self.queryset._do_iterate_profiles:
+        if self.queryset._do_union_profiles:
+            yield from self._iter_union_profiles()
+        elif self.queryset._do_resolve_profiles:
+            # profile tables weren't joined; look up the profiles in bulk. If iterator() was used then this happens
+            # one chunk at a time so that memory use and the number of queries per chunk stays bounded
+            users = super().__iter__()
+            chunk_size = self.queryset._profile_chunk_size
+            while batch := list(islice(users, chunk_size)):
+                profiles = self.queryset.model.resolve_profiles(batch, using=self.queryset.db)
+                if self.queryset._do_iterate_profiles:
+                    yield from profiles
+                else:
+                    yield from batch
+        elif self.queryset._do_iterate_profiles:
             for user in super().__iter__():
                 yield user.profile
         else:
             yield from super().__iter__()
 
+    def _iter_union_profiles(self) -> Iterable[GenericUserProfile]:
+        """
+        Fetch profiles with a single UNION ALL query (see GenericUserProfileQuerySet.union_profiles())
+        """
+        db = self.queryset.db
+        user_model = self.queryset.model
+        profile_models = _get_profile_models(user_model)
+        columns, model_aliases = _get_profile_union_columns(user_model)
+        union_qs, aliases = _build_profile_union(self.queryset, columns)
+
+        # which columns each model is constructed from
+        alias_indexes = {alias: i for i, alias in enumerate(aliases)}
+        model_columns = {
+            profile_table: (list(attname_aliases.keys()), [alias_indexes[alias] for alias in attname_aliases.values()])
+            for profile_table, attname_aliases in model_aliases.items()
+        }
+
+        rows = union_qs.iterator(chunk_size=self.chunk_size) if self.chunked_fetch else union_qs
+        for row in rows:
+            profile_table = row[-1]
+            model = profile_models[profile_table] if profile_table else user_model
+            attnames, indexes = model_columns[profile_table]
+            instance = model.from_db(db, attnames, [row[i] for i in indexes])
+            _set_cached_profile(instance, instance)
+            if not profile_table:
+                # we know that there are no profile records
+                for profile_table in user_model.related_profile_tables:
+                    _set_cached_relation(instance, profile_table, None)
+            yield instance
+
+
+class GenericUserProfileRelatedQuerySetMixin:
+    """
+    QuerySet mixin that allows "profile" to be used as the last part of select_related() and prefetch_related()
+    lookups that end at a GenericUserProfile; it will be expanded to the relevant related_profile_tables
+
+    eg. RetailLocation.objects.select_related('company__manager__profile') is equivalent to
+        User.objects.select_related_profiles(RetailLocation.objects.all(), 'company__manager')
+    """
+
+    model: Type[Model]
+
+    def select_related(self, *fields):
+        if fields == (None,):
+            return super().select_related(*fields)  # type:ignore[misc]
+        expanded_fields = [
+            expanded_field
+            for field in fields
+            for expanded_field in _expand_profile_lookup(self.model, field)
+        ]
+        if fields and not expanded_fields:
+            # everything was a profile lookup on something that is already a profile;
+            # select_related() with no fields would instead follow every FK
+            return self._chain()  # type:ignore[attr-defined]
+        return super().select_related(*expanded_fields)  # type:ignore[misc]
+
+    def prefetch_related(self, *lookups):
+        expanded_lookups: List[Union[str, Prefetch]] = []
+        for lookup in lookups:
+            if isinstance(lookup, Prefetch):
+                expanded = _expand_profile_lookup(self.model, lookup.prefetch_through)
+                if expanded == [lookup.prefetch_through]:
+                    expanded_lookups.append(lookup)
+                    continue
+                if lookup.queryset is not None or lookup.to_attr:
+                    raise ValueError(f"Prefetch('{lookup.prefetch_through}') cannot specify a queryset or to_attr")
+                expanded_lookups.extend(expanded)
+            elif lookup is None:
+                expanded_lookups.append(lookup)
+            else:
+                expanded_lookups.extend(_expand_profile_lookup(self.model, lookup))
+        return super().prefetch_related(*expanded_lookups)  # type:ignore[misc]
+
+
+def _expand_profile_lookup(model: Type[Model], lookup: str) -> List[str]:
+    """
+    Expand a lookup ending in "profile" to the relevant related_profile_tables lookups
+
+    Lookups that don't involve profiles (or that can't be resolved to a path of fields) are returned unchanged
+    """
+    parts = lookup.split(LOOKUP_SEP)
+    if 'profile' not in parts:
+        return [lookup]
 
-class GenericUserProfileQuerySet(QuerySet):
+    current_model = model
+    for i, part in enumerate(parts):
+        if part == 'profile' and issubclass(current_model, GenericUserProfile):
+            try:
+                current_model._meta.get_field(part)
+            except FieldDoesNotExist:
+                if i != len(parts) - 1:
+                    raise ValueError(f"'{lookup}': profile can only be used at the end of a lookup") from None
+                prefix = parts[:i]
+                if _is_profile(current_model):
+                    # already a profile; no extra joins needed
+                    return [LOOKUP_SEP.join(prefix)] if prefix else []
+                return [LOOKUP_SEP.join([*prefix, table]) for table in current_model.related_profile_tables]
+        try:
+            related_model = current_model._meta.get_field(part).related_model
+        except FieldDoesNotExist:
+            # not a field (eg a prefetch to_attr); let django deal with it
+            return [lookup]
+        if related_model is None or isinstance(related_model, str):
+            return [lookup]
+        current_model = related_model
+    return [lookup]
+
+
+class GenericUserProfileQuerySet(GenericUserProfileRelatedQuerySetMixin, QuerySet):
     """
     QuerySet that will iterate over user profiles if set_iterate_profiles() has been called
     """
@@ -45,6 +215,9 @@ class GenericUserProfileQuerySet(QuerySet):
         # in multiple places in BaseManager [eg _clone()]
         super().__init__(*args, **kwargs)
         self._do_iterate_profiles = False
+        self._do_resolve_profiles = False
+        self._profile_chunk_size: Optional[int] = None
+        self._do_union_profiles = False
         self._iterable_class = GenericUserProfileIterable
 
     def profiles(self) -> Self:
@@ -56,36 +229,67 @@ class GenericUserProfileQuerySet(QuerySet):
         qs._validate_iterator()
         return qs
 
-    def values(self, *args, **kwargs) -> Self:
+    def values(self, *fields, **expressions) -> Self:
+        """
+        If profiles() has been called then fields can come from both the user and profile models (None if a field
+        doesn't apply to a row's profile). If no fields are given then all user and profile fields are returned plus
+        PROFILE_TYPE_KEY (the row's related_profile_tables entry or '' if it has no profile).
+
+        This is an ordinary values() query (profile fields are annotations) so can be combined with annotate(),
+        distinct(), used as a subquery etc
+        """
+        if self._do_iterate_profiles and not _is_profile(self.model):
+            qs, fields = self._profile_values(*fields)
+            return qs.values(*fields, **expressions)
         # We want to fail early if needed rather than when the iterator is created (easier to debug)
-        qs = cast(Self, super().values(*args, **kwargs))
+        qs = cast(Self, super().values(*fields, **expressions))
         qs._validate_iterator()
         return qs
 
-    def values_list(self, *args, **kwargs) -> Self:
+    def values_list(self, *fields, flat: bool = False, named: bool = False) -> Self:
+        """
+        See values()
+        """
+        if self._do_iterate_profiles and not _is_profile(self.model):
+            qs, fields = self._profile_values(*fields)
+            return qs.values_list(*fields, flat=flat, named=named)
         # We want to fail early if needed rather than when the iterator is created (easier to debug)
-        qs = cast(Self, super().values_list(*args, **kwargs))
+        qs = cast(Self, super().values_list(*fields, flat=flat, named=named))
         qs._validate_iterator()
         return qs
 
-    def _validate_iterator(self):
+    def _profile_values(self, *fields) -> Tuple[Self, Tuple[str, ...]]:
         """
-        We shouldn't use values() and values_list() in conjunction with profiles()
+        Annotate the profile fields needed for values()/values_list() on a profiles() queryset
 
-        (each dict would have different fields, would lead to subtle bugs)
+        :return: (queryset that no longer iterates over profiles, field names to pass to values()/values_list())
+        """
+        qs = self._chain()
+        qs._do_iterate_profiles = qs._do_resolve_profiles = qs._do_union_profiles = False
+        qs._iterable_class = GenericUserProfileIterable
+        if not fields:
+            fields = _get_profile_values_default_fields(qs)
+        annotations = _get_profile_values_annotations(qs, fields)
+        if annotations:
+            qs = qs.annotate(**annotations)
+        return qs, tuple(fields)
+
+    def _validate_iterator(self):
+        """
+        values() and values_list() need to be called after profiles() so that the profile-aware iterators are used
 
         This might also be caused if _iterable_class is overwritten with something that
         does not extend GenericUserProfileIterable (also a dev mistake).
-
-        This is not a hard restriction and is only intended to catch developer mistakes; this constraint may
-        be relaxed in future when the need arises.
         """
         if self._do_iterate_profiles and not issubclass(self._iterable_class, GenericUserProfileIterable):
-            raise ValueError('Bad _iterable_class. (Trying to use values()/values_list() with profiles()? This has not been implemented yet)')
+            raise ValueError('Bad _iterable_class. (Calling values()/values_list() before profiles()?)')
 
     def _clone(self, **kwargs):
         qs = super()._clone(**kwargs)  # type:ignore[misc]  # not in django stubs
         qs._do_iterate_profiles = self._do_iterate_profiles
+        qs._do_resolve_profiles = self._do_resolve_profiles
+        qs._profile_chunk_size = self._profile_chunk_size
+        qs._do_union_profiles = self._do_union_profiles
         return qs
 
     def _get_related_profile_tables(self) -> List[str]:
@@ -100,26 +304,160 @@ class GenericUserProfileQuerySet(QuerySet):
     def select_related_profiles(self) -> Self:
         """
         Adds relevant select_related() joins so that user_to_profile() doesn't trigger extra queries
+
+        If the model has a profile_type_field then no joins are added; instead each user's profile is
+        fetched from the one table that matches its profile type (see resolve_profile_types())
         """
         if _is_profile(self.model):
             # is already a profile table so no need to do any joins
             return self._clone()
+        if self.model.profile_type_field:
+            return self.resolve_profile_types()
         return self.select_related(*self.model.related_profile_tables)
 
     def prefetch_related_profiles(self) -> Self:
         """
-        Adds relevant select_related() joins so that user_to_profile() doesn't trigger extra queries
+        Prefetch profiles so that user_to_profile() doesn't trigger extra queries
+
+        Profiles are looked up with GenericUserProfile.resolve_profiles() as records are fetched rather than with
+        prefetch_related(): this works with iterator() (one batch of queries per chunk) and profiles() doesn't
+        have to wait for the whole queryset to be fetched.
+
+        If the model has a profile_type_field then only the tables matching a fetched user's profile type
+        will be queried (see resolve_profile_types())
         """
         if _is_profile(self.model):
             # is already a profile table so no need to do any joins
             return self._clone()
-        return self.prefetch_related(*self.model.related_profile_tables)
+        qs = self._clone()
+        qs._do_resolve_profiles = True
+        return qs
+
+    def prefetch_related(self, *lookups) -> Self:
+        qs = cast(Self, super().prefetch_related(*lookups))
+        if lookups == (None,):
+            qs._do_resolve_profiles = False
+        return qs
+
+    def resolve_profile_types(self) -> Self:
+        """
+        Fetch profiles using the denormalised profile type (see GenericUserProfile.profile_type_field)
+
+        User records are fetched without any joins, then each profile table that matches at least one user's
+        profile type is queried once. Fetching a single profile is two primary key lookups.
+        """
+        if not self.model.profile_type_field:
+            raise ValueError(f"{self.model.__name__} does not define a profile_type_field")
+        qs = self._clone()
+        qs._do_resolve_profiles = not _is_profile(self.model)
+        return qs
+
+    def union_profiles(self) -> Self:
+        """
+        Return a queryset that will iterate over profiles fetched with a single UNION ALL query
+
+        There is one branch per profile table (joined to just that table) plus one for users without a profile;
+        columns that don't belong to a branch's profile are NULL. If the model has a profile_type_field then users
+        whose profile type is stale (no matching profile record) are left out. This avoids both the wide N-way outer join
+        of select_related_profiles() and the extra round trips of prefetch_related_profiles().
+
+        Ordering and slicing are applied to the combined query so can only refer to fields on the user model.
+        select_related() and deferred fields are not supported.
+        """
+        if _is_profile(self.model):
+            # is already a profile table so there is nothing to combine
+            return self.profiles()
+        if self.query.combinator:
+            raise ValueError("union_profiles() cannot be used on a combined queryset")
+        qs = self.profiles()
+        qs._do_union_profiles = True
+        _get_profile_union_ordering(qs)  # fail early on unsupported ordering
+        return qs
+
+    def count_by_profile_type(self) -> Dict[str, int]:
+        """
+        Count the users in this queryset for each entry in related_profile_tables ('' for users without a profile)
+
+        This is a single query; if the model has a profile_type_field then no joins are needed
+        """
+        if _is_profile(self.model):
+            raise ValueError("count_by_profile_type() should be called on the user model, not a profile model")
+        qs = self._chain()
+        qs._do_iterate_profiles = qs._do_resolve_profiles = qs._do_union_profiles = False
+        qs._iterable_class = GenericUserProfileIterable
+        qs = qs.order_by()
+
+        profile_tables = self.model.related_profile_tables
+        counts = {profile_table: 0 for profile_table in profile_tables}
+        counts[''] = 0
+
+        field_name = self.model.profile_type_field
+        if field_name:
+            for profile_type, count in qs.values_list(field_name).annotate(count=Count('pk')):
+                profile_type = profile_type or ''
+                if profile_type in counts:
+                    counts[profile_type] += count
+                else:
+                    logger.warning(
+                        f"Ignoring {count} {self.model.__name__} record(s) with unknown profile type "
+                        f"'{profile_type}'; use update_profile_types() to recalculate"
+                    )
+            return counts
+
+        aggregates = {}
+        no_profile = Q()
+        for i, profile_table in enumerate(profile_tables):
+            # get_profile() uses the first matching table
+            aggregates[f'profile_count_{i}'] = Count('pk', filter=no_profile & Q(**{f'{profile_table}__isnull': False}))
+            no_profile &= Q(**{f'{profile_table}__isnull': True})
+        aggregates['profile_count_none'] = Count('pk', filter=no_profile)
+        result = qs.aggregate(**aggregates)
+        for i, profile_table in enumerate(profile_tables):
+            counts[profile_table] = result[f'profile_count_{i}']
+        counts[''] = result['profile_count_none']
+        return counts
+
+    def update_profile_types(self) -> None:
+        """
+        Recalculate the profile type column for all users in this queryset
+
+        The profile type is automatically kept up to date when saving or deleting individual records;
+        this is intended for backfilling existing data (eg. in a data migration) or after bulk operations
+        that bypass model signals (eg. QuerySet.update())
+        """
+        field_name = self.model.profile_type_field
+        if not field_name:
+            raise ValueError(f"{self.model.__name__} does not define a profile_type_field")
+        if _is_profile(self.model):
+            raise ValueError("update_profile_types() should be called on the user model, not a profile model")
+
+        empty_value = _get_empty_profile_type(self.model)
+        qs = self.order_by()
+        with transaction.atomic(using=self.db):
+            qs.update(**{field_name: empty_value})
+            # apply in reverse so that the earliest matching table wins (same as get_profile())
+            for profile_table in reversed(self.model.related_profile_tables):
+                qs.filter(**{f'{profile_table}__isnull': False}).update(**{field_name: profile_table})
 
     def iterator(self, chunk_size: Optional[int]=None):
         # extra validation check in case some subclass overwrote our other validation checks
         self._validate_iterator()
+        if self._do_resolve_profiles:
+            # resolve profiles one chunk at a time rather than for the whole queryset
+            qs = self._clone()
+            qs._profile_chunk_size = chunk_size or 2000  # same default as QuerySet.iterator()
+            return super(GenericUserProfileQuerySet, qs).iterator(chunk_size)
         return super().iterator(chunk_size)
 
+    def aiterator(self, chunk_size: int = 2000):
+        self._validate_iterator()
+        if self._do_resolve_profiles:
+            # resolve profiles one chunk at a time rather than for the whole queryset
+            qs = self._clone()
+            qs._profile_chunk_size = chunk_size
+            return super(GenericUserProfileQuerySet, qs).aiterator(chunk_size)
+        return super().aiterator(chunk_size)
+
 
 def _is_profile(model: Type[Model]) -> bool:
     """
@@ -133,6 +471,417 @@ def _is_profile(model: Type[Model]) -> bool:
     return bool(model._meta.parents)
 
 
+def _get_user_model(model: Type[GenericUserProfile]) -> Type[GenericUserProfile]:
+    """
+    Given a User or UserProfile model, return the (root) User model
+    """
+    while model._meta.parents:
+        model = next(iter(model._meta.parents))
+    return model
+
+
+def _get_profile_models(model: Type[GenericUserProfile]) -> Dict[str, Type[GenericUserProfile]]:
+    """
+    Map each entry in related_profile_tables to its profile model
+    """
+    user_model = _get_user_model(model)
+    return {
+        profile_table: user_model._meta.get_field(profile_table).related_model  # type:ignore[misc]
+        for profile_table in user_model.related_profile_tables
+    }
+
+
+def _get_profile_type(model: Type[GenericUserProfile]) -> Optional[str]:
+    """
+    Return the entry in related_profile_tables that model corresponds to (None if model is not a profile)
+    """
+    if not _is_profile(model):
+        return None
+    for profile_table, profile_model in _get_profile_models(model).items():
+        if issubclass(model, profile_model):
+            return profile_table
+    return None
+
+
+def _get_empty_profile_type(model: Type[GenericUserProfile]) -> Optional[str]:
+    """
+    The value to store in the profile type column for users without a profile
+    """
+    assert model.profile_type_field is not None
+    return None if model._meta.get_field(model.profile_type_field).null else ''
+
+
+def _sync_profile_type_receiver(sender: Type[GenericUserProfile], instance: GenericUserProfile, raw: bool, using: str, **kwargs):
+    """
+    pre_save receiver that keeps profile_type_field up to date when a profile record is saved
+
+    This also covers save_base() being called directly, including raw saves (eg. loaddata)
+    """
+    profile_type = _get_profile_type(sender)
+    if profile_type is None:
+        return
+    field_name = sender.profile_type_field
+    assert field_name is not None
+    setattr(instance, field_name, profile_type)
+    if raw:
+        # raw saves don't save parent records so the user record needs to be updated separately
+        user_model = _get_user_model(sender)
+        user_model._base_manager.using(using).filter(pk=instance.pk).update(**{field_name: profile_type})
+
+
+def connect_profile_type_signals():
+    """
+    Connect the signals that keep profile_type_field up to date; this is called by AllianceUtilsAppConfig.ready()
+    """
+    for model in apps.get_models():
+        if issubclass(model, GenericUserProfile) and model.profile_type_field and _is_profile(model):
+            pre_save.connect(
+                _sync_profile_type_receiver,
+                sender=model,
+                dispatch_uid=f'allianceutils.profile_type:{model._meta.label_lower}',
+            )
+
+
+def _set_cached_profile(user: GenericUserProfile, profile: GenericUserProfile, profile_table: Optional[str] = None):
+    """
+    Store a profile that has been looked up so that neither user.profile nor user.<profile_table> need a query
+    """
+    user.__dict__['profile'] = profile
+    if profile is not user:
+        profile.__dict__['profile'] = profile
+        if profile_table is not None:
+            _set_cached_relation(user, profile_table, profile)
+
+
+def _set_cached_relation(user: GenericUserProfile, profile_table: str, profile: Optional[GenericUserProfile]):
+    """
+    Store the result of looking up user.<profile_table> (None if the user has no record in that table)
+    """
+    rel = user._meta.get_field(profile_table)
+    rel.set_cached_value(user, profile)  # type:ignore[union-attr]
+    if profile is not None:
+        rel.field.set_cached_value(profile, user)  # type:ignore[union-attr]
+
+
+def _populate_profile_relations(
+    model: Type[GenericUserProfile],
+    users: List[GenericUserProfile],
+    using: Optional[str],
+):
+    """
+    Populate the related_profile_tables relation caches for users so that get_profile() doesn't need to query
+
+    If model has a profile_type_field then only the table matching each user's profile type is queried, otherwise
+    each table is queried in turn for just those users that haven't yet been matched. Either way this is at most
+    one query per profile table.
+    """
+    user_model = _get_user_model(model)
+    profile_models = _get_profile_models(user_model)
+
+    # users that already have a profile (or are a profile) don't need anything
+    pending = [user for user in users if 'profile' not in user.__dict__ and not _is_profile(type(user))]
+
+    if user_model.profile_type_field:
+        users_by_type: Dict[str, List[GenericUserProfile]] = defaultdict(list)
+        for user in pending:
+            profile_type = getattr(user, user_model.profile_type_field)
+            if profile_type:
+                users_by_type[profile_type].append(user)
+            else:
+                _set_cached_profile(user, user)
+
+        for profile_type, typed_users in users_by_type.items():
+            try:
+                profile_model = profile_models[profile_type]
+            except KeyError:
+                # not in related_profile_tables; get_profile() will fall back to the (slow) default lookup
+                continue
+            rel = user_model._meta.get_field(profile_type)
+            lookup_users = [user for user in typed_users if not rel.is_cached(user)]  # type:ignore[union-attr]
+            if not lookup_users:
+                continue
+            profiles = profile_model._base_manager.db_manager(using).in_bulk([user.pk for user in lookup_users])
+            for user in lookup_users:
+                profile = profiles.get(user.pk)
+                if profile is not None:
+                    _set_cached_relation(user, profile_type, profile)
+                # otherwise the profile type is stale; get_profile() will fall back to the (slow) default lookup
+        return
+
+    for profile_table, profile_model in profile_models.items():
+        if not pending:
+            break
+        rel = user_model._meta.get_field(profile_table)
+        # skip anything that has already been fetched (eg by select_related())
+        lookup_users = [user for user in pending if not rel.is_cached(user)]  # type:ignore[union-attr]
+        if lookup_users:
+            profiles = profile_model._base_manager.db_manager(using).in_bulk([user.pk for user in lookup_users])
+            for user in lookup_users:
+                _set_cached_relation(user, profile_table, profiles.get(user.pk))
+        # get_profile() stops at the first matching table so there's no need to check the remaining tables
+        pending = [user for user in pending if rel.get_cached_value(user) is None]  # type:ignore[union-attr]
+
+
+def _get_profile_union_ordering(qs: GenericUserProfileQuerySet) -> List[str]:
+    """
+    Return the ordering of qs as a list of field names on the user model
+    """
+    if qs.query.order_by:
+        ordering = qs.query.order_by
+    elif qs.query.default_ordering:
+        ordering = qs.model._meta.ordering
+    else:
+        ordering = []
+
+    field_names = []
+    for order in ordering:
+        if not isinstance(order, str) or order == '?':
+            raise ValueError(f"Profile union queries only support ordering by field names (got {order!r})")
+        descending = order.startswith('-')
+        name = order.lstrip('-')
+        try:
+            field = qs.model._meta.pk if name == 'pk' else qs.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            field = None
+        if field is None or not field.concrete or field.model is not qs.model:
+            raise ValueError(f"Profile union queries only support ordering by fields on {qs.model.__name__} (got {order!r})")
+        field_names.append(('-' if descending else '') + field.attname)  # type:ignore[union-attr]
+    return field_names
+
+
+# alias -> ({profile table (None for every branch): lookup}, output field)
+_ProfileUnionColumns = Dict[str, Tuple[Dict[Optional[str], str], Any]]
+
+_PROFILE_UNION_TYPE_ALIAS = 'profile_union_type'
+
+# key used for the profile type in profile values()/values_list()
+PROFILE_TYPE_KEY = 'profile_type'
+
+
+def _get_profile_union_columns(
+    user_model: Type[GenericUserProfile],
+) -> Tuple[_ProfileUnionColumns, Dict[str, Dict[str, str]]]:
+    """
+    Lay out the columns needed to construct the user model and every profile model from a profile union
+
+    :return: (columns, {profile table ('' for the user model): {attname: alias}})
+    """
+    columns: _ProfileUnionColumns = {}
+    user_aliases: Dict[str, str] = {}
+    for field in user_model._meta.concrete_fields:
+        alias = user_aliases[field.attname] = f'profile_union_{len(columns)}'
+        columns[alias] = ({None: field.attname}, field)
+
+    model_aliases = {'': user_aliases}
+    for profile_table, profile_model in _get_profile_models(user_model).items():
+        profile_aliases = model_aliases[profile_table] = {}
+        for field in profile_model._meta.concrete_fields:
+            if field.model is not profile_model:
+                # inherited from the user model
+                profile_aliases[field.attname] = user_aliases[field.attname]
+            elif field.remote_field and field.remote_field.parent_link:  # type:ignore[union-attr]
+                # same value as the user model's pk
+                profile_aliases[field.attname] = user_aliases[user_model._meta.pk.attname]
+            else:
+                alias = profile_aliases[field.attname] = f'profile_union_{len(columns)}'
+                columns[alias] = ({profile_table: f'{profile_table}__{field.name}'}, field)
+    return columns, model_aliases
+
+
+def _get_profile_values_local_fields(qs: GenericUserProfileQuerySet) -> Dict[str, Dict[str, Any]]:
+    """
+    The fields (by both name and attname) that each profile model adds to the user model
+
+    :return: {profile table: {name: field}}
+    """
+    profile_fields: Dict[str, Dict[str, Any]] = {}
+    for profile_table, profile_model in _get_profile_models(qs.model).items():
+        fields = profile_fields[profile_table] = {}
+        for field in profile_model._meta.concrete_fields:
+            if field.model is not profile_model or field.remote_field and field.remote_field.parent_link:
+                continue
+            fields[field.name] = fields[field.attname] = field
+    return profile_fields
+
+
+def _get_profile_values_default_fields(qs: GenericUserProfileQuerySet) -> List[str]:
+    """
+    The fields returned by profile values()/values_list() if none are specified
+    """
+    field_names = [field.attname for field in qs.model._meta.concrete_fields]
+    for fields in _get_profile_values_local_fields(qs).values():
+        field_names += [field.attname for name, field in fields.items() if name == field.attname and name not in field_names]
+    field_names += [name for name in qs.query.annotation_select if name not in field_names]
+    if PROFILE_TYPE_KEY not in field_names:
+        field_names.append(PROFILE_TYPE_KEY)
+    return field_names
+
+
+def _get_profile_values_annotations(qs: GenericUserProfileQuerySet, field_names: Iterable[str]) -> Dict[str, Any]:
+    """
+    Expressions for the profile fields (and PROFILE_TYPE_KEY) in field_names
+
+    Anything that can be resolved on the user model is left to values() itself. get_profile() uses the first
+    matching table so each expression does the same.
+    """
+    user_model = qs.model
+    profile_fields = _get_profile_values_local_fields(qs)
+    field_name = user_model.profile_type_field
+    conditions = {
+        profile_table: Q(**{field_name: profile_table}) if field_name else Q(**{f'{profile_table}__isnull': False})
+        for profile_table in profile_fields
+    }
+
+    annotations: Dict[str, Any] = {}
+    for name in field_names:
+        if name in qs.query.annotations or LOOKUP_SEP in name:
+            continue
+        try:
+            user_model._meta.get_field(name)
+            continue
+        except FieldDoesNotExist:
+            pass
+
+        if name == PROFILE_TYPE_KEY:
+            annotations[name] = Case(
+                *[When(condition, then=Value(profile_table)) for profile_table, condition in conditions.items()],
+                default=Value(''),
+                output_field=CharField(),
+            )
+            continue
+
+        sources = [profile_table for profile_table, fields in profile_fields.items() if name in fields]
+        if not sources:
+            # not something we know about; let values() deal with it
+            continue
+        whens = []
+        for profile_table, condition in conditions.items():
+            if profile_table in sources:
+                whens.append(When(condition, then=F(f'{profile_table}__{name}')))
+            elif not field_name:
+                # without a profile type column an earlier table still takes priority
+                whens.append(When(condition, then=Value(None)))
+            if profile_table == sources[-1]:
+                break
+        annotations[name] = Case(*whens, default=Value(None), output_field=profile_fields[sources[0]][name])
+    return annotations
+
+
+def _build_profile_union(qs: GenericUserProfileQuerySet, columns: _ProfileUnionColumns) -> Tuple[QuerySet, List[str]]:
+    """
+    Build a UNION ALL query with one branch for each profile table plus one for users without a profile
+
+    Columns that don't apply to a branch are NULL; the last column of each row is the related_profile_tables
+    entry for that row ('' if there is no profile).
+
+    :return: (values_list() queryset, column aliases for each row)
+    """
+    user_model = qs.model
+    profile_tables = list(_get_profile_models(user_model).keys())
+
+    # ordering is applied to the combined query so needs to be one of the columns
+    columns = dict(columns)
+    ordering = []
+    for order in _get_profile_union_ordering(qs):
+        descending = order.startswith('-')
+        attname = order.lstrip('-')
+        alias = next((alias for alias, (sources, field) in columns.items() if sources == {None: attname}), None)
+        if alias is None:
+            alias = f'profile_union_order_{len(ordering)}'
+            columns[alias] = ({None: attname}, None)
+        ordering.append(('-' if descending else '') + alias)
+    aliases = [*columns.keys(), _PROFILE_UNION_TYPE_ALIAS]
+
+    base = qs._chain()
+    base._do_iterate_profiles = base._do_resolve_profiles = base._do_union_profiles = False
+    base._iterable_class = GenericUserProfileIterable
+    base.query.clear_limits()
+    base.query.clear_ordering(force=True)
+    base.query.select_related = False
+    base._prefetch_related_lookups = ()
+
+    branches = []
+    for branch_table in [*profile_tables, '']:
+        branch_filter = _get_profile_union_branch_filter(user_model, branch_table)
+        annotations = {}
+        for alias, (sources, field) in columns.items():
+            lookup = sources.get(None, sources.get(branch_table))
+            annotations[alias] = F(lookup) if lookup else Cast(Value(None), output_field=field)
+        annotations[_PROFILE_UNION_TYPE_ALIAS] = Value(branch_table, output_field=CharField())
+        branches.append(base.filter(branch_filter).annotate(**annotations).values_list(*aliases))
+    union_qs = branches[0].union(*branches[1:], all=True)
+
+    if ordering:
+        union_qs = union_qs.order_by(*ordering)
+    union_qs.query.set_limits(qs.query.low_mark, qs.query.high_mark)
+
+    return union_qs, aliases
+
+
+def _get_profile_union_branch_filter(user_model: Type[GenericUserProfile], branch_table: str) -> Q:
+    """
+    Filter for the users that belong in the profile union branch for branch_table ('' for users without a profile)
+
+    If there is a profile_type_field then that alone determines the branch. Otherwise each branch excludes users
+    that have a record in an earlier profile table (get_profile() uses the first matching table) with NOT EXISTS
+    rather than extra outer joins.
+    """
+    profile_models = _get_profile_models(user_model)
+    field_name = user_model.profile_type_field
+    if field_name:
+        if branch_table:
+            # also require the profile record (this is the same join that the branch's columns need)
+            return Q(**{field_name: branch_table, f'{branch_table}__isnull': False})
+        return ~Q(**{f'{field_name}__in': list(profile_models)})
+
+    branch_filter = Q()
+    for profile_table, profile_model in profile_models.items():
+        if profile_table == branch_table:
+            branch_filter &= Q(**{f'{profile_table}__isnull': False})
+            break
+        branch_filter &= ~Exists(profile_model._base_manager.filter(pk=OuterRef('pk')))
+    return branch_filter
+
+
+_LAZY_LOAD_MODES = ('warn', 'log', 'raise')
+
+_IGNORED_CALLER_PATHS = (
+    os.path.dirname(django.__file__) + os.sep,
+    os.path.dirname(asgiref.__file__) + os.sep,
+    __file__,
+)
+
+
+def _get_lazy_load_mode() -> Optional[str]:
+    mode = getattr(settings, 'GENERIC_USER_PROFILE_LAZY_LOAD', None)
+    if mode and mode not in _LAZY_LOAD_MODES:
+        raise ImproperlyConfigured(f"GENERIC_USER_PROFILE_LAZY_LOAD must be one of {_LAZY_LOAD_MODES} or None")
+    return mode or None
+
+
+def _get_caller() -> str:
+    """
+    Describe the innermost stack frame that isn't part of this module or django
+    """
+    for frame in reversed(traceback.extract_stack()):
+        if not frame.filename.startswith(_IGNORED_CALLER_PATHS):
+            return f'{frame.filename}:{frame.lineno} in {frame.name}'
+    return 'unknown'
+
+
+def _report_lazy_profile_load(user: GenericUserProfile, query_count: int, mode: str):
+    msg = (
+        f"Loading the profile for a {type(user).__name__} took {query_count} extra queries "
+        f"(at {_get_caller()}); use select_related_profiles(), prefetch_related_profiles() or resolve_profiles()"
+    )
+    if mode == 'raise':
+        raise LazyProfileLoadError(msg)
+    elif mode == 'log':
+        logger.warning(msg)
+    else:
+        warnings.warn(msg, LazyProfileLoadWarning)
+
+
 # Concrete models with a GenericUserProfileManagerMixin must define related_profile_tables
 def _validate_related_profile_tables(model: Type[Model], manager_name: str):
     # , model_app_name: Tuple[str, str],
@@ -220,13 +969,14 @@ class GenericUserProfileManagerMixin(BaseUserManager):
     def profiles(self) -> GenericUserProfileQuerySet:
         return self.get_queryset().profiles()
 
-    # TODO: It would be nice to be able to do something like:
-    #   SomeModel.objects.select_related('user__profile')
-    # and have the '__profile' transformed into the relevant select_related() based on model.related_profile_tables
-    # unfortunately the code to do the joins is baked into SQLCompiler.get_related_selections() and is not really
-    # extensible without being very invasive
-    #
-    # Instead we have to call select_related_profiles on an unrelated queryset with a prefix
+    def union_profiles(self) -> GenericUserProfileQuerySet:
+        return self.get_queryset().union_profiles()
+
+    def count_by_profile_type(self) -> Dict[str, int]:
+        return self.get_queryset().count_by_profile_type()
+
+    # For an unrelated queryset you can either call select_related_profiles() with a prefix or use a queryset
+    # with GenericUserProfileRelatedQuerySetMixin and select_related('user__profile')
 
     def select_related_profiles(
         self,
@@ -276,14 +1026,55 @@ class GenericUserProfile(Model):
     # to join to in order to fetch profiles [will be passed to select_related()]
     related_profile_tables: List[str]
 
+    # Optional name of a (denormalised) field on the user model that records which entry in
+    # related_profile_tables a user's profile is stored in. Kept up to date automatically when records are
+    # saved (including raw saves from loaddata) or deleted. If set then profiles can be resolved without probing
+    # or joining every profile table.
+    profile_type_field: Optional[str] = None
+
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        if self.profile_type_field:
+            profile_type = _get_profile_type(type(self))
+            if profile_type is not None and getattr(self, self.profile_type_field) != profile_type:
+                setattr(self, self.profile_type_field, profile_type)
+                update_fields = kwargs.get('update_fields')
+                if update_fields is not None and self.profile_type_field not in update_fields:
+                    kwargs['update_fields'] = [*update_fields, self.profile_type_field]
+        super().save(*args, **kwargs)
+
+    save.alters_data = True  # type:ignore[attr-defined]
+
+    def delete(self, using=None, keep_parents=False):
+        pk = self.pk
+        result = super().delete(using=using, keep_parents=keep_parents)
+        if keep_parents and self.profile_type_field and _is_profile(type(self)):
+            # the user record remains but no longer has this profile
+            user_model = _get_user_model(type(self))
+            user_model._base_manager.using(using or self._state.db).filter(pk=pk).update(
+                **{self.profile_type_field: _get_empty_profile_type(user_model)}
+            )
+        return result
+
+    delete.alters_data = True  # type:ignore[attr-defined]
+
     def get_profile(self) -> Self:
         # We're already a profile
         if _is_profile(type(self)):
             return self
 
+        if self.profile_type_field:
+            profile_type = getattr(self, self.profile_type_field)
+            if not profile_type:
+                return self
+            try:
+                return getattr(self, profile_type)
+            except AttributeError:
+                # profile type is stale; fall through to the default lookup
+                pass
+
         # try each FK reference one at a time; this will be inefficient if
         # select_related_profiles() or prefetch_related_profiles() haven't been called
         for profile_model in self.related_profile_tables:
@@ -295,6 +1086,51 @@ class GenericUserProfile(Model):
         # Nothing matches; this is a user record without a profile
         return self
 
+    @classmethod
+    def resolve_profiles(cls, users: Iterable[GenericUserProfile], using: Optional[str] = None) -> List[GenericUserProfile]:
+        """
+        Look up the profiles for a list of already fetched users in bulk
+
+        Profile tables are queried in bulk (at most one query per entry in related_profile_tables; if there is a
+        profile_type_field then only the tables that users actually have profiles in) and the results cached so
+        that both user.profile and the individual profile relations can subsequently be accessed without queries.
+        Users whose profile has already been loaded are skipped.
+
+        :param users: User (or profile) records
+        :param using: Database alias to query; defaults to the database the first user was loaded from
+        :return: The profile for each user, in the same order as users
+        """
+        users = list(users)
+        if not users:
+            return []
+        if using is None:
+            using = users[0]._state.db
+        _populate_profile_relations(cls, users, using)
+        return [user.profile for user in users]
+
+    @classmethod
+    async def aresolve_profiles(
+        cls,
+        users: Iterable[GenericUserProfile],
+        using: Optional[str] = None,
+    ) -> List[GenericUserProfile]:
+        """
+        Async version of resolve_profiles()
+        """
+        return await sync_to_async(cls.resolve_profiles)(users, using)
+
+    async def aget_profile(self) -> Self:
+        """
+        Async equivalent of the profile property: returns the (cached) profile for this record
+
+        Accessing .profile directly from async code will raise SynchronousOnlyOperation if the profile
+        hasn't already been loaded (eg. by select_related_profiles() or resolve_profiles())
+        """
+        try:
+            return self.__dict__['profile']
+        except KeyError:
+            return await sync_to_async(lambda: self.profile)()
+
     class _CachedProfileDescriptor:
         """
         Evaluates and caches the result of get_profile()
@@ -309,7 +1145,15 @@ class GenericUserProfile(Model):
                 # class invocation
                 return self
 
-            user_profile = obj.get_profile()
+            lazy_load_mode = None if _is_profile(type(obj)) else _get_lazy_load_mode()
+            if lazy_load_mode:
+                counter = QueryCounter()
+                with connections[obj._state.db or DEFAULT_DB_ALIAS].execute_wrapper(counter):
+                    user_profile = obj.get_profile()
+                if counter.count:
+                    _report_lazy_profile_load(obj, counter.count, lazy_load_mode)
+            else:
+                user_profile = obj.get_profile()
 
             # cache the result on all records in the multi-table inheritance chain
             record: Optional[GenericUserProfile] = user_profile
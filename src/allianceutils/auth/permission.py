@@ -1,20 +1,41 @@
 from collections.abc import Iterable
+from contextlib import contextmanager
+from functools import partial
 import logging
+import time
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Sequence
+from typing import Set
 from typing import Tuple
 from typing import Union
 import warnings
+from weakref import WeakKeyDictionary
 
+from asgiref.local import Local
 from django.contrib.auth import get_backends
+from django.core.signals import setting_changed
 from django.db.models import Model
+from django.db.models import Q
+from django.db.models import QuerySet
+from django.dispatch import receiver
 from django.http import Http404
 from django.http import HttpRequest
+from django.urls import get_resolver
+from django.urls import get_urlconf
 from django.urls import resolve
 from django.urls import reverse
-import rules.permissions # type: ignore[import-not-found]
+from django.urls import URLResolver
+
+try:
+    import rules.permissions  # type: ignore[import-not-found]
+except ImportError:
+    # django-rules is optional; without it there are simply no rules to consult
+    rules = None
 
 logger = logging.getLogger("allianceutils")
 
@@ -39,12 +60,270 @@ class AmbiguousGlobalPermissionWarning(Warning):
     pass
 
 
+class _IdentityKey:
+    """
+    Dict key that compares by object identity (and keeps the object alive so that its id() isn't reused)
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __hash__(self) -> int:
+        return id(self.obj)
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, _IdentityKey) and other.obj is self.obj
+
+
+# request-scoped has_perm() results; see permission_cache()
+_permission_cache_state = Local()
+
+
+@contextmanager
+def permission_cache() -> Iterator[None]:
+    """
+    Cache has_perm() results (keyed by user, permission and object identity) for the duration of the block
+
+    Requires allianceutils.auth.backends.PermissionCacheBackend to be the first entry in AUTHENTICATION_BACKENDS;
+    usually you would use allianceutils.middleware.permission_cache.PermissionCacheMiddleware rather than calling
+    this directly.
+
+    Nested blocks share the outermost cache
+    """
+    previous = getattr(_permission_cache_state, "results", None)
+    if previous is None:
+        _permission_cache_state.results = {}
+    try:
+        yield
+    finally:
+        _permission_cache_state.results = previous
+
+
+def clear_permission_cache():
+    """
+    Clear cached has_perm() results for the current permission_cache() block (eg. after changing a user's permissions)
+    """
+    results = getattr(_permission_cache_state, "results", None)
+    if results is not None:
+        results.clear()
+
+
+def _get_permission_cache() -> Optional[Dict[Tuple[Any, str, _IdentityKey], bool]]:
+    """
+    The has_perm() results for the current permission_cache() block (None if there isn't one)
+    """
+    return getattr(_permission_cache_state, "results", None)
+
+
+def _get_permission_cache_key(user: Any, perm: str, obj: Optional[Model]) -> Tuple[Any, str, _IdentityKey]:
+    # different instances of the same saved user share results; anonymous users have no permissions of their own
+    if user.pk is None and not user.is_anonymous:
+        return _IdentityKey(user), perm, _IdentityKey(obj)
+    return (type(user), user.pk), perm, _IdentityKey(obj)
+
+
+class PermissionTimer:
+    """
+    Records permission checks made through allianceutils (permission classes, allianceutils.rules predicates
+    and reverse_if_probably_allowed()) inside a permission_timing() block
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # permission -> [number of checks, total time]
+        self.perms: Dict[str, List[Any]] = {}
+        self._depth = 0
+
+    @contextmanager
+    def time(self, perm: str) -> Iterator[None]:
+        """
+        Time a single permission check
+        """
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._depth -= 1
+            self.count += 1
+            # checks can be nested (eg. a rule that checks other permissions) so only count the outermost in the total
+            if self._depth == 0:
+                self.total_time += elapsed
+            perm_stats = self.perms.setdefault(perm, [0, 0.0])
+            perm_stats[0] += 1
+            perm_stats[1] += elapsed
+
+    def record_cache(self, hit: bool):
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+    def get_report(self, slowest_count: int = 5) -> Dict[str, Any]:
+        """
+        Summary of the recorded checks suitable for logging or serialising to JSON
+        """
+        lookups = self.cache_hits + self.cache_misses
+        slowest = sorted(self.perms.items(), key=lambda item: item[1][1], reverse=True)[:slowest_count]
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_time * 1000, 3),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": round(self.cache_hits / lookups, 3) if lookups else None,
+            "slowest": [
+                {"perm": perm, "count": count, "total_ms": round(total * 1000, 3)}
+                for perm, (count, total) in slowest
+            ],
+        }
+
+
+# request-scoped permission check timings; see permission_timing()
+_permission_timing_state = Local()
+
+
+@contextmanager
+def permission_timing() -> Iterator[PermissionTimer]:
+    """
+    Record permission checks made through allianceutils for the duration of the block
+
+    Usually you would use allianceutils.middleware.permission_timing.PermissionTimingMiddleware rather than calling
+    this directly.
+
+    Nested blocks share the outermost timer
+    """
+    previous = getattr(_permission_timing_state, "timer", None)
+    timer = previous or PermissionTimer()
+    _permission_timing_state.timer = timer
+    try:
+        yield timer
+    finally:
+        _permission_timing_state.timer = previous
+
+
+def _get_permission_timer() -> Optional[PermissionTimer]:
+    return getattr(_permission_timing_state, "timer", None)
+
+
+def _timed_has_perm(user: Any, perm: str, obj: Optional[Model] = None) -> bool:
+    """
+    user.has_perm() recorded by the current permission_timing() block (if any)
+    """
+    timer = _get_permission_timer()
+    if timer is None:
+        return user.has_perm(perm, obj)
+    with timer.time(perm):
+        return user.has_perm(perm, obj)
+
+
+def _timed_has_perms(user: Any, perms: Iterable[str], obj: Optional[Model] = None) -> bool:
+    """
+    user.has_perms() recorded by the current permission_timing() block (if any)
+    """
+    timer = _get_permission_timer()
+    if timer is None:
+        return user.has_perms(perms, obj)
+    with timer.time(",".join(perms)):
+        return user.has_perms(perms, obj)
+
+
+def _record_permission_cache(hit: bool):
+    """
+    Record a permission cache lookup in the current permission_timing() block (if any)
+    """
+    timer = _get_permission_timer()
+    if timer is not None:
+        timer.record_cache(hit)
+
+
+# permission name -> (whether each classification is global, the django-rules rule it was calculated from)
+_global_perms_cache: Dict[str, Tuple[Tuple[bool, ...], Any]] = {}
+
+
+def clear_global_perms_cache():
+    """
+    Clear the cache used by identify_global_perms()
+
+    This happens automatically if django-rules permissions are changed or AUTHENTICATION_BACKENDS is changed
+    (eg by override_settings()); you will need to call this yourself if backends change which permissions
+    are global at runtime
+    """
+    _global_perms_cache.clear()
+
+
+@receiver(setting_changed)
+def _clear_global_perms_cache_on_setting_changed(setting: str, **kwargs):
+    if setting == "AUTHENTICATION_BACKENDS":
+        clear_global_perms_cache()
+        clear_permission_matrix()
+
+
+def _classify_perm(perm: str, backends: List[Any]) -> Tuple[bool, ...]:
+    """
+    Determine whether a permission is global (True) or per-object (False)
+
+    This will usually be a single value but a permission could be classified by multiple backends
+    """
+    classifications = []
+    # We use 2 vars to keep track because something could be both a global & an object-level permission
+    # in different backends
+    is_global = None
+    is_object = None
+    for backend in backends:
+        if hasattr(backend, "is_global_perm"):
+            try:
+                if backend.is_global_perm(perm):
+                    is_global = True
+                    classifications.append(True)
+                else:
+                    is_object = True
+                    classifications.append(False)
+                break
+            # Permission doesn't exist in the backend
+            except ValueError:
+                pass
+        elif rules is not None and isinstance(backend, rules.permissions.ObjectPermissionBackend):
+            rule = rules.permissions.permissions.get(perm)
+            if rule:
+                if rule.num_args == 1:
+                    is_global = True
+                    classifications.append(True)
+                elif rule.num_args == 2:
+                    is_object = True
+                    classifications.append(False)
+                else:
+                    raise ValueError(f"Cannot understand arguments for django-rules {perm}")
+
+    if not is_global and not is_object:
+        classifications.append(True)
+        # TODO: should we make this configurable?
+        # if you have a permission defined outside of csvpermissions (eg in django-rules)
+        # then there's no way to know whether it's global or per-object
+        #
+        # we could also introspect django-rules if that's the other place a permission might be defined
+        warnings.warn(
+            f"Permission {perm} not found in backend that supports is_global_perm",
+            AmbiguousGlobalPermissionWarning,
+        )
+
+    return tuple(classifications)
+
+
 def identify_global_perms(perms: Union[str, Iterable[str]]) -> Tuple[List[str], List[str]]:
     """Given a permission or a list of permissions identifies which are global and which are object permissions
 
     returns (global permission list, object permission list)
+
+    Results are cached for each permission (see clear_global_perms_cache()); ambiguous permissions only
+    generate a warning the first time they are seen
     """
-    backends = get_backends()
+    backends = None
 
     if isinstance(perms, str):
         perms = [perms]
@@ -53,50 +332,236 @@ def identify_global_perms(perms: Union[str, Iterable[str]]) -> Tuple[List[str],
     object_perms = []
 
     for perm in perms:
-        # We use 2 vars to keep track because something could be both a global & an object-level permission
-        # in different backends
-        is_global = None
-        is_object = None
-        for backend in backends:
-            if hasattr(backend, "is_global_perm"):
-                try:
-                    if backend.is_global_perm(perm):
-                        is_global = True
-                        global_perms.append(perm)
-                    else:
-                        is_object = True
-                        object_perms.append(perm)
-                    break
-                # Permission doesn't exist in the backend
-                except ValueError:
-                    pass
-            elif isinstance(backend, rules.permissions.ObjectPermissionBackend):
-                rule = rules.permissions.permissions.get(perm)
-                if rule:
-                    if rule.num_args == 1:
-                        is_global = True
-                        global_perms.append(perm)
-                    elif rule.num_args == 2:
-                        is_object = True
-                        object_perms.append(perm)
-                    else:
-                        raise ValueError(f"Cannot understand arguments for django-rules {perm}")
-
-        if not is_global and not is_object:
-            global_perms.append(perm)
-            # TODO: should we make this configurable?
-            # if you have a permission defined outside of csvpermissions (eg in django-rules)
-            # then there's no way to know whether it's global or per-object
-            #
-            # we could also introspect django-rules if that's the other place a permission might be defined
-            warnings.warn(
-                f"Permission {perm} not found in backend that supports is_global_perm",
-                AmbiguousGlobalPermissionWarning,
-            )
+        # if a django-rules rule has been (re)registered then any cached result is stale
+        rule = rules.permissions.permissions.get(perm) if rules is not None else None
+        cached = _global_perms_cache.get(perm)
+        if cached is not None and cached[1] is rule:
+            classifications = cached[0]
+        else:
+            if backends is None:
+                backends = get_backends()
+            classifications = _classify_perm(perm, backends)
+            _global_perms_cache[perm] = (classifications, rule)
+
+        for is_global in classifications:
+            if is_global:
+                global_perms.append(perm)
+            else:
+                object_perms.append(perm)
 
     return global_perms, object_perms
 
 
+# (user/profile model, permission) -> (whether that type of user has the permission (None if unknown), the django-rules rule)
+_permission_matrix: Dict[Tuple[type, str], Tuple[Optional[bool], Any]] = {}
+
+
+def clear_permission_matrix():
+    """
+    Clear the role permission matrix used by get_role_global_perm()
+    """
+    _permission_matrix.clear()
+
+
+def build_permission_matrix(roles: Iterable[type], perms: Optional[Iterable[str]] = None):
+    """
+    Calculate the role permission matrix for the given user/profile models in advance rather than on first use
+
+    perms defaults to every django-rules permission
+    """
+    if perms is None:
+        perms = list(rules.permissions.permissions.keys()) if rules is not None else []
+    for role in roles:
+        for perm in perms:
+            get_role_global_perm(role, perm)
+
+
+def get_role_global_perm(role: type, perm: str) -> Optional[bool]:
+    """
+    Whether users of a given user/profile model have a global django-rules permission
+
+    The rule is evaluated once against an unsaved instance of the model and the result is kept in memory (until the
+    rule is re-registered or clear_permission_matrix() is called). This is only meaningful for rules that depend
+    solely on the type of user: a rule that reads field values (eg. is_staff) sees the field defaults, so only call
+    this for permissions known to be type-only (see PermissionMatrixBackendMixin.permission_matrix_perms).
+
+    Returns None if perm is not a global django-rules permission or the rule needs more than the type of user
+    """
+    if rules is None:
+        return None
+    rule = rules.permissions.permissions.get(perm)
+    if rule is None:
+        return None
+
+    key = (role, perm)
+    cached = _permission_matrix.get(key)
+    if cached is not None and cached[1] is rule:
+        return cached[0]
+
+    result = None
+    global_perms, object_perms = identify_global_perms(perm)
+    if not object_perms:
+        try:
+            result = rule.test(role())
+        except Exception:
+            # eg. the rule needs related records which an unsaved user doesn't have
+            logger.debug(f"Cannot evaluate {perm} for {role.__name__} without a user", exc_info=True)
+    _permission_matrix[key] = (result, rule)
+    return result
+
+
+# permission name -> function taking a user and returning a Q object matching the records they have that permission on
+_perm_filters: Dict[str, Callable[[Any], Q]] = {}
+
+
+def register_perm_filter(perm: str, perm_filter: Optional[Callable[[Any], Q]] = None):
+    """
+    Register the queryset equivalent of an object permission: a function that takes a user and returns a Q object
+    matching the records that user has the permission on (eg. the SQL version of a django-rules predicate)
+
+    This lets list views filter in a single query instead of checking each object; see filter_queryset_by_perms()
+
+    Can be used as a decorator::
+
+        @register_perm_filter("myapp.view_order")
+        def view_order_filter(user):
+            return Q(customer=user)
+    """
+    if perm_filter is None:
+        return partial(register_perm_filter, perm)
+    _perm_filters[perm] = perm_filter
+    return perm_filter
+
+
+def remove_perm_filter(perm: str):
+    """
+    Remove a filter added with register_perm_filter()
+    """
+    _perm_filters.pop(perm, None)
+
+
+def get_perm_filter(perm: str) -> Optional[Callable[[Any], Q]]:
+    """
+    Get the filter registered with register_perm_filter() for a permission (or None if there isn't one)
+    """
+    return _perm_filters.get(perm)
+
+
+def filter_queryset_by_perms(user: Any, perms: Union[str, Iterable[str]], queryset: QuerySet) -> QuerySet:
+    """
+    Narrow a queryset to the records that a user has all of the given permissions on
+
+    Permissions the user holds globally don't restrict anything; other permissions use the filter from
+    register_perm_filter(). If any permission is neither held globally nor has a filter then nothing matches
+    """
+    if isinstance(perms, str):
+        perms = [perms]
+
+    q = Q()
+    for perm in perms:
+        if _timed_has_perm(user, perm):
+            continue
+        perm_filter = _perm_filters.get(perm)
+        if perm_filter is None:
+            return queryset.none()
+        q &= perm_filter(user)
+    return queryset.filter(q)
+
+
+def get_objects_with_perms(user: Any, perms: Union[str, Iterable[str]], objects: Iterable[Model]) -> Set[Model]:
+    """
+    Find which of the given objects (or queryset) a user has all of the given permissions on
+
+    Equivalent to checking user.has_perms(perms, obj) for each object but
+    - permissions the user holds globally are only checked once
+    - permissions with a filter from register_perm_filter() are checked with a single query for each model
+    - any other permissions fall back to checking each object
+    """
+    if isinstance(perms, str):
+        perms = [perms]
+
+    allowed = list(objects)
+    for perm in perms:
+        if not allowed:
+            break
+        if _timed_has_perm(user, perm):
+            continue
+        perm_filter = _perm_filters.get(perm)
+        if perm_filter is None:
+            allowed = [obj for obj in allowed if _timed_has_perm(user, perm, obj)]
+        else:
+            allowed = _filter_objects(user, perm, allowed, perm_filter(user))
+    return set(allowed)
+
+
+def _filter_objects(user: Any, perm: str, objects: List[Model], q: Q) -> List[Model]:
+    """
+    Filter objects to those that match q in the database
+    """
+    pks_by_model: Dict[type, List[Any]] = {}
+    for obj in objects:
+        if obj.pk is not None:
+            pks_by_model.setdefault(type(obj), []).append(obj.pk)
+
+    allowed_pks = {
+        model: set(model._base_manager.filter(pk__in=pks).filter(q).values_list("pk", flat=True))
+        for model, pks in pks_by_model.items()
+    }
+
+    return [
+        obj for obj in objects
+        # unsaved objects aren't in the database so have to be checked individually
+        if (obj.pk in allowed_pks[type(obj)] if obj.pk is not None else _timed_has_perm(user, perm, obj))
+    ]
+
+
+# (viewname, args, kwargs, object); trailing items can be omitted
+ReverseSpec = Union[str, Sequence[Any]]
+
+# URL resolver -> {(viewname, number of args, kwarg names): (view func, view class)} for viewnames with a single pattern
+# Resolvers are recreated when URLconfs are reloaded (see django.urls.clear_url_caches()) which discards their entries
+_view_cache: "WeakKeyDictionary[URLResolver, Dict[Tuple[Any, ...], Tuple[Any, Optional[type]]]]" = WeakKeyDictionary()
+
+
+def _get_view(viewname: str, target_href: str, args: List[Any], kwargs: Dict[str, Any]) -> Tuple[Any, Optional[type]]:
+    """
+    Find the view func & class for a reversed URL, only calling resolve() the first time a view is seen
+    """
+    resolver = get_resolver(get_urlconf())
+    try:
+        view_classes = _view_cache[resolver]
+    except KeyError:
+        view_classes = _view_cache[resolver] = {}
+
+    key = (viewname, len(args), tuple(sorted(kwargs.keys())))
+    try:
+        return view_classes[key]
+    except KeyError:
+        pass
+
+    func = resolve(target_href).func
+    view = (func, getattr(func, "view_class", None))
+    # a name shared by several patterns (eg. with different path converters) may resolve to a different view
+    # depending on the argument values so only a name that matches a single pattern can be cached
+    if _is_single_pattern_viewname(resolver, viewname):
+        view_classes[key] = view
+    return view
+
+
+def _is_single_pattern_viewname(resolver: URLResolver, viewname: str) -> bool:
+    """
+    Whether a (possibly namespaced) viewname matches exactly one URL pattern
+    """
+    *namespaces, name = viewname.split(":")
+    for namespace in namespaces:
+        try:
+            _, resolver = resolver.namespace_dict[namespace]
+        except KeyError:
+            # eg. an application namespace that depends on current_app; let resolve() work it out each time
+            return False
+    return len(resolver.reverse_dict.getlist(name)) == 1
+
+
 def reverse_if_probably_allowed(
     request: HttpRequest,
     viewname: str,
@@ -113,7 +578,51 @@ def reverse_if_probably_allowed(
 
     If unsure, this function will return the URL
     """
+    return reverse_if_probably_allowed_many(request, [(viewname, args, kwargs, object)])[0]
 
+
+def reverse_if_probably_allowed_many(request: HttpRequest, specs: Iterable[ReverseSpec]) -> List[Optional[str]]:
+    """
+    Batch version of reverse_if_probably_allowed() for when there are many links to check (eg. menus)
+
+    Each spec is either a viewname or a (viewname, args, kwargs, object) tuple (trailing items can be omitted).
+    Returns the URL (or None) for each spec.
+
+    Each distinct permission & object combination is only checked once
+    """
+    perm_results: Dict[Tuple[str, _IdentityKey], bool] = {}
+
+    def has_perms(perms: List[str], obj: Optional[Model]) -> bool:
+        for perm in perms:
+            # objects are keyed by identity since model equality is by pk (and unsaved objects are all unequal)
+            key = (perm, _IdentityKey(obj))
+            try:
+                result = perm_results[key]
+                _record_permission_cache(True)
+            except KeyError:
+                _record_permission_cache(False)
+                result = perm_results[key] = _timed_has_perm(request.user, perm, obj)
+            if not result:
+                return False
+        return True
+
+    results = []
+    for spec in specs:
+        if isinstance(spec, str):
+            spec = (spec,)
+        viewname, args, kwargs, object = (*spec, None, None, None)[:4]
+        results.append(_reverse_if_probably_allowed(request, viewname, object, args, kwargs, has_perms))
+    return results
+
+
+def _reverse_if_probably_allowed(
+    request: HttpRequest,
+    viewname: str,
+    object: Optional[Model],
+    args: Optional[List[Any]],
+    kwargs: Optional[Dict[str, Any]],
+    has_perms: Callable[[List[str], Optional[Model]], bool],
+) -> Optional[str]:
     if kwargs is None:
         kwargs = dict()
 
@@ -121,18 +630,17 @@ def reverse_if_probably_allowed(
         args = []
 
     target_href = reverse(viewname, args=args, kwargs=kwargs)
-    target_match = resolve(target_href)
+    target_func, target_class = _get_view(viewname, target_href, args, kwargs)
 
     # ------------------------------------------
     # fully instantiating and running a view might be costly (and have side effects)
     # so we just do a permission check ourselves. This is not 100% accurate (it knows nothing
     # about has_perm customisations for example) but in the worst case the user will simply
     # see a link that gives them a 403 when they try to click on it
-    target_class = getattr(target_match.func, "view_class", None)
 
     if not target_class:
         # we only handle classes, not view functions
-        warnings.warn(f"Not sure how to check permission on view func {target_match.func}")
+        warnings.warn(f"Not sure how to check permission on view func {target_func}")
         # TODO: reinstate this check in KF292
         # if settings.DEBUG:
         #     raise NotImplementedError("guess_view_permission() doesn't work with " + str(target_match.func))
@@ -198,4 +706,4 @@ def reverse_if_probably_allowed(
     if isinstance(perm, str):
         perm = [perm]
 
-    return target_href if request.user.has_perms(perm, perm_object) else None
+    return target_href if has_perms(perm, perm_object) else None
@@ -0,0 +1,21 @@
+from collections.abc import Callable
+
+from django.http import HttpRequest
+from django.http import HttpResponse
+
+from allianceutils.auth.permission import permission_cache
+
+
+class PermissionCacheMiddleware(object):
+    """Caches has_perm() results for the duration of each request
+
+    To setup add ``allianceutils.middleware.permission_cache.PermissionCacheMiddleware`` to :setting:`MIDDLEWARE` and
+    ``allianceutils.auth.backends.PermissionCacheBackend`` as the first entry in :setting:`AUTHENTICATION_BACKENDS`
+    """
+
+    def __init__(self, get_response: Callable):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        with permission_cache():
+            return self.get_response(request)
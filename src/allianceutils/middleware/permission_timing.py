@@ -0,0 +1,44 @@
+from collections.abc import Callable
+import json
+import logging
+
+from django.conf import settings
+from django.http import HttpRequest
+from django.http import HttpResponse
+
+from allianceutils.auth.permission import permission_timing
+
+logger = logging.getLogger("allianceutils")
+
+
+class PermissionTimingMiddleware(object):
+    """Reports the permission checks made through allianceutils during each request
+
+    To setup add ``allianceutils.middleware.permission_timing.PermissionTimingMiddleware`` to :setting:`MIDDLEWARE`
+
+    When DEBUG is on the report is added to the response as a JSON ``X-Permission-Timing`` header,
+    otherwise it is logged to the ``allianceutils`` logger with the report in the ``permission_timing``
+    attribute of the log record
+    """
+
+    header = "X-Permission-Timing"
+
+    def __init__(self, get_response: Callable):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        with permission_timing() as timer:
+            response = self.get_response(request)
+
+        if not timer.count and not timer.cache_hits:
+            return response
+
+        report = timer.get_report(getattr(settings, "PERMISSION_TIMING_SLOWEST_COUNT", 5))
+        if settings.DEBUG:
+            response[self.header] = json.dumps(report, separators=(",", ":"))
+        else:
+            logger.info(
+                f"permission checks: request '{request.method} {request.path}' made {report['count']} checks in {report['total_ms']}ms",
+                extra={"permission_timing": report},
+            )
+        return response
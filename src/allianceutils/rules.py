@@ -1,5 +1,68 @@
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
 import rules
 
+from allianceutils.auth.permission import _IdentityKey
+from allianceutils.auth.permission import _record_permission_cache
+from allianceutils.auth.permission import _timed_has_perm
+
+# (predicate type, permissions) -> predicate
+# predicates keep no state of their own so identical predicates can be shared
+_predicates: Dict[Tuple[str, Tuple[str, ...]], rules.Predicate] = {}
+_predicates_lock = threading.Lock()
+
+
+def _check_perm(predicate: rules.Predicate, user: Any, perm: str, obj: Any) -> bool:
+    """
+    user.has_perm() memoized for the current rules invocation, so a permission shared by
+    several branches of a composed rule is only checked once
+    """
+    context = predicate.context
+    if context is None:
+        # called directly rather than through test()
+        return _timed_has_perm(user, perm, obj)
+
+    key = (_check_perm, _IdentityKey(user), perm, _IdentityKey(obj))
+    try:
+        result = context[key]
+        _record_permission_cache(True)
+    except KeyError:
+        _record_permission_cache(False)
+        result = context[key] = _timed_has_perm(user, perm, obj)
+    return result
+
+
+def _get_predicate(
+    kind: str,
+    perms: Iterable[str],
+    obj: Optional[Any],
+    make_check: Callable[[Tuple[str, ...], Optional[Any]], Callable],
+) -> rules.Predicate:
+    if isinstance(perms, str):
+        raise ValueError("perms must be an iterable of permissions")
+    perms = tuple(perms)
+    name = f'{kind}:' + ','.join(perms)
+
+    if obj is not None:
+        # don't keep objects alive by interning them
+        return rules.predicates.predicate(name, bind=True)(make_check(perms, obj))
+
+    key = (kind, perms)
+    try:
+        return _predicates[key]
+    except KeyError:
+        pass
+    with _predicates_lock:
+        if key not in _predicates:
+            _predicates[key] = rules.predicates.predicate(name, bind=True)(make_check(perms, obj))
+        return _predicates[key]
+
 
 def has_perm(perm, obj=None):
     """
@@ -8,13 +71,12 @@ def has_perm(perm, obj=None):
     :param perm: permission to check
     :return: django_rules predicate
     """
-    name = f'has_perm:{perm}'
+    def make_check(perms, obj):
+        def check(self, user):
+            return _check_perm(self, user, perms[0], obj)
+        return check
 
-    @rules.predicates.predicate(name)
-    def check(user):
-        return user.has_perm(perm, obj)
-
-    return check
+    return _get_predicate('has_perm', [perm], obj, make_check)
 
 
 def has_perms(perms, obj=None):
@@ -24,13 +86,12 @@ def has_perms(perms, obj=None):
     :param perms: permissions to check
     :return: django_rules predicate
     """
-    name = 'has_perms:' + ','.join(perms)
-
-    @rules.predicates.predicate(name)
-    def check(user):
-        return user.has_perms(perms, obj)
+    def make_check(perms, obj):
+        def check(self, user):
+            return all(_check_perm(self, user, perm, obj) for perm in perms)
+        return check
 
-    return check
+    return _get_predicate('has_perms', perms, obj, make_check)
 
 
 def has_any_perms(perms, obj=None):
@@ -40,10 +101,10 @@ def has_any_perms(perms, obj=None):
     :param *perms: permissions to check
     :return: django_rules predicate
     """
-    name = 'has_any_perms:' + ','.join(perms)
-
-    @rules.predicates.predicate(name)
-    def check(user):
-        return any(user.has_perm(perm, obj) for perm in perms)
+    def make_check(perms, obj):
+        def check(self, user):
+            # stops at the first permission the user has
+            return any(_check_perm(self, user, perm, obj) for perm in perms)
+        return check
 
-    return check
+    return _get_predicate('has_any_perms', perms, obj, make_check)
@@ -8,8 +8,8 @@ from ..webpack import WebpackEntryPointLoader
 register = template.Library()
 
 
-@register.simple_tag
-def render_entry_point(entry_point_name:str, resource_type:str, attrs:str='', config:str='DEFAULT'):
+@register.simple_tag(takes_context=True)
+def render_entry_point(context, entry_point_name:str, resource_type:str, attrs:str='', config:str='DEFAULT'):
     """
     For a specified entry point render HTML tags to embed all associated resource bundles limited to
     specified resource type (eg. 'js', 'css').
@@ -19,6 +19,8 @@ def render_entry_point(entry_point_name:str, resource_type:str, attrs:str='', co
     :param attrs: Optional attributes to pass through to the underlying HTML tag (eg. 'crossorigin')
     :param config: Config identifier to use. Maps to a key in WEBPACK_LOADER settings.
 
+    If PRECOMPRESSED_ROOT is configured and the template context contains a request then chunks with a
+    pre-compressed (.br/.gz) sibling that the client accepts (as per Accept-Encoding) will link to that sibling instead.
 
     Example:
     
@@ -36,5 +38,7 @@ def render_entry_point(entry_point_name:str, resource_type:str, attrs:str='', co
     """
     webpack_settings: dict = settings.WEBPACK_LOADER[config]  # type:ignore[misc]  # we've added a new settings
     loader = WebpackEntryPointLoader(webpack_settings)
-    tags = get_chunk_tags(loader.get_chunks_for_entry_point(entry_point_name, resource_type), attrs)
+    request = context.get('request')
+    accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING') if request is not None else None
+    tags = get_chunk_tags(loader.get_chunks_for_entry_point(entry_point_name, resource_type, accept_encoding), attrs)
     return mark_safe('\n'.join(tags))
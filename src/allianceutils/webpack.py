@@ -1,18 +1,30 @@
 import json
 import logging
+import mimetypes
+import os
+from pathlib import Path
+import posixpath
+import threading
 import time
 from typing import Dict
+from typing import FrozenSet
 from typing import Generator
 from typing import Iterable
 from typing import Optional
 from typing import Sequence
+from typing import Tuple
+from typing import Union
 from urllib.parse import ParseResult
 from urllib.parse import quote
 from urllib.parse import urljoin
 from urllib.parse import urlparse
 
 from django.conf import settings
+from django.http import HttpRequest
+from django.http import HttpResponse
 from django.templatetags.static import static
+from django.utils.cache import patch_vary_headers
+from django.views.static import serve
 
 logger = logging.Logger('webpack')
 
@@ -54,8 +66,149 @@ def get_chunk_tags(chunks: Iterable[Dict], attrs: str):
 config_defaults = {
     "INCLUDE_QUERY_HASH": True,
     "BASE_URL": None,
+    "PRECOMPRESSED_ROOT": None,
 }
 
+# Pre-compressed file suffixes and the Content-Encoding they are served with, in order of preference
+PRECOMPRESSED_ENCODINGS = {
+    'br': '.br',
+    'gzip': '.gz',
+}
+
+_precompressed_index: Dict[str, Dict[str, FrozenSet[str]]] = {}
+_precompressed_index_lock = threading.Lock()
+
+
+def get_precompressed_index(root: Union[str, Path]) -> Dict[str, FrozenSet[str]]:
+    """
+    Get the pre-compressed variants available under a directory
+
+    The directory is only scanned the first time it is requested; subsequent calls return the cached index.
+    Use clear_precompressed_index() if the files on disk change (eg. after a rebuild without restarting)
+
+    :return: dict mapping uncompressed file path (relative to root, using / as a separator) to the set of
+        encodings (see PRECOMPRESSED_ENCODINGS) that have a pre-compressed sibling file
+    """
+    root = str(root)
+    try:
+        return _precompressed_index[root]
+    except KeyError:
+        pass
+
+    with _precompressed_index_lock:
+        if root not in _precompressed_index:
+            index: Dict[str, set] = {}
+            for dir_path, dir_names, file_names in os.walk(root):
+                rel_dir = os.path.relpath(dir_path, root)
+                for file_name in file_names:
+                    for encoding, suffix in PRECOMPRESSED_ENCODINGS.items():
+                        if file_name.endswith(suffix):
+                            original = posixpath.normpath(
+                                posixpath.join(rel_dir.replace(os.sep, '/'), file_name[:-len(suffix)])
+                            )
+                            index.setdefault(original, set()).add(encoding)
+            _precompressed_index[root] = {name: frozenset(encodings) for name, encodings in index.items()}
+
+    return _precompressed_index[root]
+
+
+def clear_precompressed_index():
+    """
+    Clear the cached index of pre-compressed files
+    """
+    with _precompressed_index_lock:
+        _precompressed_index.clear()
+
+
+def get_accepted_encodings(accept_encoding: Optional[str]) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """
+    Parse an Accept-Encoding header and return the content codings the client will accept and the codings
+    it explicitly rejects (q=0)
+    """
+    accepted = set()
+    rejected = set()
+    for part in (accept_encoding or '').split(','):
+        coding, *params = [p.strip() for p in part.split(';')]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if q > 0:
+            accepted.add(coding.lower())
+        else:
+            rejected.add(coding.lower())
+    return frozenset(accepted), frozenset(rejected)
+
+
+def choose_precompressed_encoding(
+    available_encodings: Iterable[str],
+    accept_encoding: Optional[str],
+) -> Optional[str]:
+    """
+    Choose the preferred encoding (see PRECOMPRESSED_ENCODINGS) that is both available and accepted by the client
+
+    '*' only matches codings that weren't explicitly rejected with q=0
+
+    Returns None if the uncompressed file should be used
+    """
+    accepted, rejected = get_accepted_encodings(accept_encoding)
+    for encoding in PRECOMPRESSED_ENCODINGS:
+        if encoding not in available_encodings:
+            continue
+        if encoding in accepted or ('*' in accepted and encoding not in rejected):
+            return encoding
+    return None
+
+
+def serve_precompressed(
+    request: HttpRequest,
+    path: str,
+    document_root: Union[str, Path],
+    show_indexes: bool = False,
+) -> HttpResponse:
+    """
+    Drop-in replacement for django.views.static.serve() that serves pre-compressed (.br/.gz) siblings
+
+    - A request for an explicit variant (eg. app.bundle.js.br) is served with the Content-Type of the uncompressed
+      file and the matching Content-Encoding
+    - A request for an uncompressed file is served from the best pre-compressed sibling the client accepts (if any)
+
+    Which variants exist comes from get_precompressed_index(); the filesystem is not probed per request
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    index = get_precompressed_index(document_root)
+
+    encoding = None
+    original_path = path
+    for candidate_encoding, suffix in PRECOMPRESSED_ENCODINGS.items():
+        if path.endswith(suffix) and candidate_encoding in index.get(path[:-len(suffix)], ()):
+            encoding = candidate_encoding
+            original_path = path[:-len(suffix)]
+            break
+    else:
+        encoding = choose_precompressed_encoding(index.get(path, ()), request.META.get('HTTP_ACCEPT_ENCODING'))
+        if encoding:
+            path = path + PRECOMPRESSED_ENCODINGS[encoding]
+
+    response = serve(request, path, document_root=document_root, show_indexes=show_indexes)
+
+    if original_path in index:
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+    if encoding and response.status_code == 200:
+        content_type, _ = mimetypes.guess_type(original_path)
+        response.headers['Content-Type'] = content_type or 'application/octet-stream'
+        response.headers['Content-Encoding'] = encoding
+
+    return response
+
+
 class WebpackEntryPointLoader:
 
     extensions_by_resource_type = {
@@ -150,8 +303,21 @@ class WebpackEntryPointLoader:
                 return resource_type
         return None
 
-    def get_chunk_url(self, public_path: str, chunk: Dict) -> str:
+    def get_chunk_encoding(self, chunk: Dict, accept_encoding: Optional[str]) -> Optional[str]:
+        """
+        Get the encoding of the pre-compressed variant of a chunk to use for a client
+
+        Returns None if there is no suitable variant or PRECOMPRESSED_ROOT is not configured
+        """
+        if not self.config['PRECOMPRESSED_ROOT'] or not accept_encoding:
+            return None
+        available = get_precompressed_index(self.config['PRECOMPRESSED_ROOT']).get(chunk['name'], ())
+        return choose_precompressed_encoding(available, accept_encoding)
+
+    def get_chunk_url(self, public_path: str, chunk: Dict, encoding: Optional[str] = None) -> str:
         name = chunk['name']
+        if encoding:
+            name += PRECOMPRESSED_ENCODINGS[encoding]
         query = ''
         if self.config['INCLUDE_QUERY_HASH'] and chunk.get('contentHash'):
             query = f'?{chunk["contentHash"]}'
@@ -160,20 +326,32 @@ class WebpackEntryPointLoader:
             return urljoin(self.config['BASE_URL'], path)
         return path
 
-    def filter_chunks(self, public_path: str, chunks: Sequence[Dict], required_resource_type:str) -> Generator[dict, None, None]:
+    def filter_chunks(
+        self,
+        public_path: str,
+        chunks: Sequence[Dict],
+        required_resource_type:str,
+        accept_encoding: Optional[str] = None,
+    ) -> Generator[dict, None, None]:
         if required_resource_type not in self.extensions_by_resource_type:
             valid_resource_types = ', '.join(self.extensions_by_resource_type.keys())
             raise ValueError(f'Invalid chunk type {required_resource_type}. Must be one of: {valid_resource_types}')
         for chunk in chunks:
             resource_type = self.get_resource_type(chunk)
             if required_resource_type == resource_type:
+                encoding = self.get_chunk_encoding(chunk, accept_encoding)
                 yield {
-                    'url': self.get_chunk_url(public_path, chunk),
+                    'url': self.get_chunk_url(public_path, chunk, encoding),
                     'resource_type': resource_type,
                     **chunk,
                 }
 
-    def get_chunks_for_entry_point(self, entry_point_name:str, resource_type:str) ->  Generator[dict, None, None]:
+    def get_chunks_for_entry_point(
+        self,
+        entry_point_name:str,
+        resource_type:str,
+        accept_encoding: Optional[str] = None,
+    ) ->  Generator[dict, None, None]:
         stats = self.load_stats()
         if stats['status'] == 'compiling':
             logger.warning('Webpack is compiling... web requests will wait until this resolves before loading')
@@ -201,4 +379,4 @@ class WebpackEntryPointLoader:
             raise ValueError(f'Invalid entry point {entry_point_name}. Known entry points: {known_entry_points}')
         public_path = stats.get('publicPath', '')
 
-        return self.filter_chunks(public_path, entry_point, resource_type)
+        return self.filter_chunks(public_path, entry_point, resource_type, accept_encoding)
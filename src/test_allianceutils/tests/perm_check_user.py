@@ -0,0 +1,13 @@
+class PermissionCheckUser:
+    """
+    User that records permission checks
+
+    allowed_perms entries are either a permission name (allowed for any object) or a (permission, object) tuple
+    """
+    def __init__(self, allowed_perms):
+        self.allowed_perms = allowed_perms
+        self.checked_perms = []
+
+    def has_perm(self, perm, obj=None):
+        self.checked_perms.append((perm, obj))
+        return perm in self.allowed_perms or (perm, obj) in self.allowed_perms
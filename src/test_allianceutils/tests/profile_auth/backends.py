@@ -12,3 +12,7 @@ class ProfileModelBackend(ProfileModelBackendMixin, MinimalModelBackend):
     if TYPE_CHECKING:
         def get_user(self, user_id: int) -> User | None:  # type:ignore[override] # narrowing from superclass
             ...
+
+
+class CachedProfileModelBackend(ProfileModelBackend):
+    profile_cache_alias = 'default'
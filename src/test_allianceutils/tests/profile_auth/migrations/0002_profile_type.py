@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:59
+
+import allianceutils.auth.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profile_auth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileTypeUser',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('profile_type', models.CharField(blank=True, max_length=64)),
+            ],
+            options={
+                'abstract': False,
+            },
+            managers=[
+                ('objects', allianceutils.auth.models.GenericUserProfileManager()),
+                ('profiles', allianceutils.auth.models.GenericUserProfileManager(select_related_profiles=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProfileTypeAdminProfile',
+            fields=[
+                ('profiletypeuser_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='profile_auth.profiletypeuser')),
+                ('admin_details', models.CharField(max_length=191)),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=('profile_auth.profiletypeuser',),
+            managers=[
+                ('objects', allianceutils.auth.models.GenericUserProfileManager()),
+                ('profiles', allianceutils.auth.models.GenericUserProfileManager(select_related_profiles=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProfileTypeCustomerProfile',
+            fields=[
+                ('profiletypeuser_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='profile_auth.profiletypeuser')),
+                ('customer_details', models.CharField(max_length=191)),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=('profile_auth.profiletypeuser',),
+            managers=[
+                ('objects', allianceutils.auth.models.GenericUserProfileManager()),
+                ('profiles', allianceutils.auth.models.GenericUserProfileManager(select_related_profiles=True)),
+            ],
+        ),
+    ]
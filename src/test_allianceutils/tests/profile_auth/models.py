@@ -91,9 +91,39 @@ class AdminProfile(User):
     admin_details = models.CharField(max_length=191)
 
 
+class UserFKQuerySet(allianceutils.auth.models.GenericUserProfileRelatedQuerySetMixin, models.QuerySet):
+    pass
+
+
 class UserFKImmediateModel(models.Model):
     fk = models.ForeignKey(to=User, on_delete=models.CASCADE)
 
+    objects = UserFKQuerySet.as_manager()
+
 
 class UserFKIndirectModel(models.Model):
     fk = models.ForeignKey(to=UserFKImmediateModel, on_delete=models.CASCADE)
+
+    objects = UserFKQuerySet.as_manager()
+
+
+class ProfileTypeUser(allianceutils.auth.models.GenericUserProfile):
+    """
+    User model that has a denormalised profile type column
+    """
+    related_profile_tables = [
+        'profiletypecustomerprofile',
+        'profiletypeadminprofile',
+    ]
+    profile_type_field = 'profile_type'
+
+    name = models.CharField(max_length=128)
+    profile_type = models.CharField(max_length=64, blank=True)
+
+
+class ProfileTypeCustomerProfile(ProfileTypeUser):
+    customer_details = models.CharField(max_length=191)
+
+
+class ProfileTypeAdminProfile(ProfileTypeUser):
+    admin_details = models.CharField(max_length=191)
@@ -2,13 +2,21 @@ from __future__ import annotations
 
 import io
 import random
+from unittest import mock
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractBaseUser
+from django.core.cache import cache
+from django.core.exceptions import FieldError
 from django.core.management import call_command
 from django.db import IntegrityError
+from django.db.models import Count
+from django.db.models import F
 from django.db.models import Manager
 from django.db.models import Model
+from django.db.models import OuterRef
+from django.db.models import Prefetch
+from django.db.models import Subquery
 from django.forms import IntegerField
 from django.forms import ModelForm
 from django.test import Client
@@ -18,11 +26,21 @@ from django.test.utils import isolate_apps
 from django.urls import reverse
 from django.utils.http import urlencode
 
+from allianceutils.auth.backends import get_cached_profile
+from allianceutils.auth.backends import invalidate_cached_profile
+from allianceutils.auth.backends import set_cached_profile
 from allianceutils.auth.models import GenericUserProfile
+from allianceutils.auth.models import LazyProfileLoadError
+from allianceutils.auth.models import LazyProfileLoadWarning
 from allianceutils.checks import ID_ERROR_PROFILE_RELATED_TABLES
 
+from .backends import CachedProfileModelBackend
+from .backends import ProfileModelBackend
 from .models import AdminProfile
 from .models import CustomerProfile
+from .models import ProfileTypeAdminProfile
+from .models import ProfileTypeCustomerProfile
+from .models import ProfileTypeUser
 from .models import User
 from .models import UserFKImmediateModel
 from .models import UserFKIndirectModel
@@ -466,6 +484,10 @@ class AuthTestCase(TestCase):
                     (lambda qs: select_related(qs)              .get(pk=referrer.id), 1, 0),
                     (lambda qs: qs.prefetch_related('fk__fk')   .get(pk=referrer.id), 3, self.get_profile_query_count(original_profile)),
                     (lambda qs: prefetch_related(qs)            .get(pk=referrer.id), 5, 0),
+                    (lambda qs: qs.select_related('fk__fk__profile')                   .get(pk=referrer.id), 1, 0),
+                    (lambda qs: qs.prefetch_related('fk__fk__profile')                 .get(pk=referrer.id), 5, 0),
+                    (lambda qs: qs.prefetch_related(Prefetch('fk__fk__profile'))       .get(pk=referrer.id), 5, 0),
+                    (lambda qs: qs.select_related('fk').prefetch_related('fk__fk__profile').get(pk=referrer.id), 4, 0),
                 )
 
                 for i, (op_func, select_query_count, profile_query_count) in enumerate(operation_query_counts):
@@ -482,6 +504,26 @@ class AuthTestCase(TestCase):
                             profile = profile.profile.profile
                         self.assertIs(type(original_profile), type(profile))
 
+    def test_profile_lookup_errors(self):
+        with self.assertRaises(ValueError):
+            UserFKIndirectModel.objects.select_related('fk__fk__profile__adminprofile')
+        with self.assertRaises(ValueError):
+            UserFKIndirectModel.objects.prefetch_related(Prefetch('fk__fk__profile', queryset=User.objects.all()))
+        with self.assertRaises(ValueError):
+            UserFKIndirectModel.objects.prefetch_related(Prefetch('fk__fk__profile', to_attr='user_profile'))
+
+    def test_profile_lookup_on_user(self):
+        with self.assertNumQueries(1):
+            users = list(User.objects.select_related('profile'))
+        with self.assertNumQueries(0):
+            self.assertEqual({u.pk: type(u.profile) for u in users}, {pk: type(p) for pk, p in self.profiles.items()})
+
+        # is a no-op on profiles
+        with self.assertNumQueries(1):
+            profiles = list(AdminProfile.objects.select_related('profile'))
+        with self.assertNumQueries(0):
+            self.assertEqual({p.profile for p in profiles}, {self.admin1, self.admin2})
+
     def test_select_prefetch_related_profile(self):
         # select/prefetch_related_profiles() on User means no extra queries
         # select/prefetch_related_profiles() on something that's already a profile is a nooop
@@ -518,13 +560,78 @@ class AuthTestCase(TestCase):
         self.assertEqual(errors_good_user, [])
 
     def test_values(self):
-        # You're not allowed to call values on a profile list
-        qs = User.profiles.select_related_profiles()
-        with self.assertRaises(ValueError):
-            qs.values()
+        qs = User.profiles.select_related_profiles().order_by('pk')
+        ordered_profiles = [self.profiles[pk] for pk in sorted(self.profiles)]
+
+        def profile_type(profile):
+            return {CustomerProfile: 'customerprofile', AdminProfile: 'adminprofile'}.get(type(profile), '')
+
+        # one query and no model instances
+        with self.assertNumQueries(1):
+            values = list(qs.values())
+        self.assertEqual(
+            set(values[0].keys()),
+            {f.attname for f in User._meta.concrete_fields} | {'customer_details', 'admin_details', 'profile_type'},
+        )
+        self.assertEqual(
+            [(v['id'], v['email'], v['customer_details'], v['admin_details'], v['profile_type']) for v in values],
+            [
+                (p.pk, p.email, getattr(p, 'customer_details', None), getattr(p, 'admin_details', None), profile_type(p))
+                for p in ordered_profiles
+            ],
+        )
+
+        with self.assertNumQueries(1):
+            values = list(qs.values('pk', 'admin_details', 'profile_type'))
+        self.assertEqual(
+            values,
+            [{'pk': p.pk, 'admin_details': getattr(p, 'admin_details', None), 'profile_type': profile_type(p)} for p in ordered_profiles],
+        )
+
+        self.assertEqual(
+            list(qs.values_list('email', 'customer_details')),
+            [(p.email, getattr(p, 'customer_details', None)) for p in ordered_profiles],
+        )
+        self.assertEqual(
+            list(qs.filter(pk__in=[self.admin1.pk, self.admin2.pk]).values_list('admin_details', flat=True)),
+            [self.admin1.admin_details, self.admin2.admin_details],
+        )
+        row = qs.values_list('email', 'profile_type', named=True)[1]
+        self.assertEqual((row.email, row.profile_type), (ordered_profiles[1].email, profile_type(ordered_profiles[1])))
+        self.assertEqual(
+            list(qs.order_by('-pk').values_list('email', flat=True)),
+            [p.email for p in reversed(ordered_profiles)],
+        )
+
+        with self.assertRaises(FieldError):
+            qs.values('not_a_field')
 
+        # this is an ordinary values() query so can be aggregated, made distinct or used as a subquery
+        self.assertEqual(
+            User.objects.filter(email__in=User.profiles.values('email')).count(),
+            len(self.profiles),
+        )
+        emails = User.objects.annotate(
+            profile_email=Subquery(User.profiles.filter(pk=OuterRef('pk')).values('email')[:1]),
+        ).values_list('profile_email', flat=True)
+        self.assertEqual(sorted(emails), sorted(p.email for p in ordered_profiles))
+        self.assertEqual(
+            list(User.profiles.values('is_staff').annotate(n=Count('pk'))),
+            [{'is_staff': False, 'n': len(self.profiles)}],
+        )
+        self.assertEqual(list(User.profiles.values_list('is_staff', flat=True).distinct()), [False])
+        self.assertEqual(
+            {row['profile_type']: row['n'] for row in User.profiles.values('profile_type').annotate(n=Count('pk'))},
+            {'': 1, 'customerprofile': 2, 'adminprofile': 2},
+        )
+        self.assertEqual(
+            list(qs.filter(pk=self.admin1.pk).values('pk', admin=F('adminprofile__admin_details'))),
+            [{'pk': self.admin1.pk, 'admin': self.admin1.admin_details}],
+        )
+
+        # profiles() has to be called before values()
         with self.assertRaises(ValueError):
-            qs.values_list()
+            User.objects.values().profiles()
 
     def test_count(self):
         # we don't do anything special with aggregate queries; they should work as normal
@@ -542,9 +649,408 @@ class AuthTestCase(TestCase):
             set(['admin1@example.com', 'admin2@example.com'])
         )
 
+    def test_resolve_profiles(self):
+        users = list(User.objects.order_by('pk'))
+        # one query per profile table; the last table only needs to be queried for users not already matched
+        with self.assertNumQueries(len(User.related_profile_tables)):
+            profiles = User.resolve_profiles(users)
+        with self.assertNumQueries(0):
+            self.assertEqual([type(p) for p in profiles], [type(self.profiles[u.pk]) for u in users])
+            self.assertEqual([u.profile for u in users], profiles)
+            self.assertEqual(users[1].adminprofile.pk, users[1].pk)
+            with self.assertRaises(CustomerProfile.DoesNotExist):
+                users[1].customerprofile
+            with self.assertRaises(AdminProfile.DoesNotExist):
+                users[0].adminprofile
+
+        # already resolved profiles & profile records don't need to be looked up again
+        with self.assertNumQueries(0):
+            self.assertEqual(User.resolve_profiles(users + [self.admin2]), profiles + [self.admin2])
+            self.assertEqual(User.resolve_profiles([]), [])
+
+        # already selected relations are reused
+        users = list(User.objects.select_related('customerprofile').order_by('pk'))
+        with self.assertNumQueries(1):
+            User.resolve_profiles(users)
+
+    def test_iterator_prefetch_profiles(self):
+        expected_types = [type(self.profiles[pk]) for pk in sorted(self.profiles)]
+
+        # profiles are resolved as records are fetched, not after
+        with self.assertNumQueries(self.PREFETCH_QUERY_COUNT):
+            profiles = list(User.objects.prefetch_related_profiles().profiles().order_by('pk'))
+        self.assertEqual([type(p) for p in profiles], expected_types)
+
+        # chunk_size is not required
+        with self.assertNumQueries(self.PREFETCH_QUERY_COUNT):
+            profiles = list(User.objects.prefetch_related_profiles().profiles().order_by('pk').iterator())
+        self.assertEqual([type(p) for p in profiles], expected_types)
+
+        # chunks are [user, admin], [customer, customer], [admin]
+        # profile tables are queried once per chunk until every user in the chunk is matched
+        with self.assertNumQueries(1 + 2 + 1 + 2):
+            profiles = list(User.objects.prefetch_related_profiles().profiles().order_by('pk').iterator(chunk_size=2))
+        self.assertEqual([type(p) for p in profiles], expected_types)
+
+        with self.assertNumQueries(1 + 2 + 1 + 2):
+            users = list(User.objects.prefetch_related_profiles().order_by('pk').iterator(chunk_size=2))
+        with self.assertNumQueries(0):
+            self.assertEqual([type(u.profile) for u in users], expected_types)
+
+    def test_union_profiles(self):
+        expected = {pk: type(p) for pk, p in self.profiles.items()}
+
+        with self.assertNumQueries(1) as ctx:
+            profiles = list(User.objects.union_profiles())
+        sql = ctx.captured_queries[0]['sql']
+        self.assertIn('UNION ALL', sql)
+        # each profile branch only joins its own table; earlier tables are excluded with NOT EXISTS
+        self.assertEqual(sql.count('JOIN'), len(User.related_profile_tables))
+        self.assertIn('NOT EXISTS', sql)
+        self.assertEqual({p.pk: type(p) for p in profiles}, expected)
+        with self.assertNumQueries(0):
+            for profile in profiles:
+                self.assertIs(profile.profile, profile)
+                original = self.profiles[profile.pk]
+                self.assertEqual(profile.email, original.email)
+                self.assertEqual(getattr(profile, 'customer_details', None), getattr(original, 'customer_details', None))
+                self.assertEqual(getattr(profile, 'admin_details', None), getattr(original, 'admin_details', None))
+            user = next(p for p in profiles if p.pk == self.user1.pk)
+            with self.assertRaises(CustomerProfile.DoesNotExist):
+                user.customerprofile
+
+        # filtering, ordering & slicing
+        with self.assertNumQueries(1):
+            profiles = list(User.objects.filter(pk__in=[self.admin1.pk, self.customer1.pk, self.user1.pk]).union_profiles().order_by('-pk')[:2])
+        self.assertEqual(
+            [(p.pk, type(p)) for p in profiles],
+            sorted([(self.admin1.pk, AdminProfile), (self.customer1.pk, CustomerProfile), (self.user1.pk, User)], reverse=True)[:2]
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(type(User.objects.union_profiles().get(pk=self.admin2.pk)), AdminProfile)
+        self.assertEqual(User.objects.union_profiles().count(), len(self.profiles))
+
+        with self.assertNumQueries(1):
+            profiles = list(User.objects.union_profiles().iterator())
+        self.assertEqual({p.pk: type(p) for p in profiles}, expected)
+
+        # a user that (incorrectly) has multiple profiles only appears once
+        AdminProfile(user_ptr=self.customer1, email=self.customer1.email, admin_details='x').save_base(raw=True)
+        profiles = list(User.objects.union_profiles())
+        self.assertEqual({p.pk: type(p) for p in profiles}, expected)
+
+        with self.assertRaises(ValueError):
+            User.objects.order_by('customerprofile__customer_details').union_profiles()
+        with self.assertRaises(ValueError):
+            list(User.objects.union_profiles().order_by('customerprofile__customer_details'))
+
+    async def test_async(self):
+        expected_types = [type(self.profiles[pk]) for pk in sorted(self.profiles)]
+
+        profiles = [p async for p in User.profiles.order_by('pk')]
+        self.assertEqual([type(p) for p in profiles], expected_types)
+
+        qs = User.objects.prefetch_related_profiles().profiles().order_by('pk')
+        profiles = [p async for p in qs.aiterator(chunk_size=2)]
+        self.assertEqual([type(p) for p in profiles], expected_types)
+
+        self.assertIs(type(await User.profiles.aget(pk=self.admin1.pk)), AdminProfile)
+
+        user = await User.objects.aget(pk=self.customer1.pk)
+        profile = await user.aget_profile()
+        self.assertIs(type(profile), CustomerProfile)
+        self.assertIs(await profile.aget_profile(), profile)
+        self.assertIs(await user.aget_profile(), profile)
+
+        users = [u async for u in User.objects.order_by('pk')]
+        profiles = await User.aresolve_profiles(users)
+        self.assertEqual([type(p) for p in profiles], expected_types)
+
+        backend = ProfileModelBackend()
+        self.assertIs(type(await backend.aget_user(self.admin2.pk)), AdminProfile)
+        self.assertIsNone(await backend.aget_user(-1))
+
+    def test_lazy_load_detection(self):
+        with override_settings(GENERIC_USER_PROFILE_LAZY_LOAD='raise'):
+            user = User.objects.get(pk=self.admin1.pk)
+            with self.assertRaisesRegex(LazyProfileLoadError, r'2 extra queries \(at .*tests\.py:\d+ in test_lazy_load_detection\)'):
+                user.profile
+
+            # no extra queries
+            User.objects.select_related_profiles().get(pk=self.admin1.pk).profile
+            AdminProfile.objects.get(pk=self.admin1.pk).profile
+            users = list(User.objects.all())
+            User.resolve_profiles(users)
+            [user.profile for user in users]
+
+        with override_settings(GENERIC_USER_PROFILE_LAZY_LOAD='warn'):
+            with self.assertWarns(LazyProfileLoadWarning):
+                User.objects.get(pk=self.customer1.pk).profile
+
+        with override_settings(GENERIC_USER_PROFILE_LAZY_LOAD='log'):
+            with self.assertLogs('allianceutils', 'WARNING'):
+                User.objects.get(pk=self.user1.pk).profile
+
+        with override_settings(GENERIC_USER_PROFILE_LAZY_LOAD=None):
+            User.objects.get(pk=self.admin1.pk).profile
+
+    def test_count_by_profile_type(self):
+        with self.assertNumQueries(1) as ctx:
+            counts = User.objects.count_by_profile_type()
+        self.assertEqual(counts, {'customerprofile': 2, 'adminprofile': 2, '': 1})
+        self.assertNotIn('INNER JOIN', ctx.captured_queries[0]['sql'])
+
+        # respects filters
+        counts = User.profiles.filter(pk__in=[self.user1.pk, self.admin1.pk]).count_by_profile_type()
+        self.assertEqual(counts, {'customerprofile': 0, 'adminprofile': 1, '': 1})
+
+        # a user that (incorrectly) has multiple profiles is only counted once
+        AdminProfile(user_ptr=self.customer1, email=self.customer1.email, admin_details='x').save_base(raw=True)
+        self.assertEqual(User.objects.count_by_profile_type(), {'customerprofile': 2, 'adminprofile': 2, '': 1})
+
     def test_case_sensitivity(self):
         user = AdminProfile.objects.get(email="admin1@EXAMPLE.COM")
         # case insensitivity is actually a responsibility of the email field (via db_collation=...)
         self.assertNotEqual(user.email, "admin1@EXAMPLE.COM")
         self.assertEqual(user.email.lower(), "admin1@example.com")
 
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=(
+        'test_allianceutils.tests.profile_auth.backends.CachedProfileModelBackend',
+    ),
+)
+class CachedProfileBackendTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.backend = CachedProfileModelBackend()
+        self.admin = AdminProfile.objects.create(email='admin@example.com', admin_details='a')
+        self.customer = CustomerProfile.objects.create(email='customer@example.com', customer_details='c')
+
+    def test_get_user(self):
+        with self.assertNumQueries(1):
+            profile = self.backend.get_user(self.admin.pk)
+        with self.assertNumQueries(0):
+            cached = self.backend.get_user(self.admin.pk)
+            self.assertEqual(type(cached), AdminProfile)
+            self.assertEqual(cached.admin_details, 'a')
+            self.assertIs(cached.profile, cached)
+        self.assertIsNot(cached, profile)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(type(self.backend.get_user(self.customer.pk)), CustomerProfile)
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.backend.get_user(-1))
+
+    def test_invalidation(self):
+        self.backend.get_user(self.admin.pk)
+        self.backend.get_user(self.customer.pk)
+
+        # saving the profile
+        self.admin.admin_details = 'b'
+        self.admin.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_user(self.admin.pk).admin_details, 'b')
+
+        # saving the underlying user record
+        user = User.objects.get(pk=self.admin.pk)
+        user.first_name = 'Alice'
+        user.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_user(self.admin.pk).first_name, 'Alice')
+
+        # changes that bypass signals need explicit invalidation
+        User.objects.filter(pk=self.admin.pk).update(first_name='Bob')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.backend.get_user(self.admin.pk).first_name, 'Alice')
+        invalidate_cached_profile(self.admin.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_user(self.admin.pk).first_name, 'Bob')
+
+        # other users are unaffected
+        with self.assertNumQueries(0):
+            self.backend.get_user(self.customer.pk)
+
+        self.admin.delete()
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.backend.get_user(self.admin.pk))
+
+    def test_invalidation_during_load(self):
+        # another request invalidates the profile after this one has loaded it from the database
+        get = User.profiles.get
+
+        def get_then_invalidate(*args, **kwargs):
+            profile = get(*args, **kwargs)
+            invalidate_cached_profile(self.admin.pk)
+            return profile
+
+        with mock.patch.object(User.profiles, 'get', get_then_invalidate):
+            self.assertEqual(self.backend.get_user(self.admin.pk), self.admin)
+        # the stale profile wasn't cached
+        with self.assertNumQueries(1):
+            self.backend.get_user(self.admin.pk)
+        with self.assertNumQueries(0):
+            self.backend.get_user(self.admin.pk)
+
+    def test_set_after_invalidation(self):
+        stale = User.profiles.get(pk=self.admin.pk)
+        self.assertIsNone(get_cached_profile('default', self.admin.pk))
+        invalidate_cached_profile(self.admin.pk)
+        # setting never creates a new version
+        set_cached_profile('default', stale, None)
+        self.assertIsNone(get_cached_profile('default', self.admin.pk))
+
+        # but can set once the current version has been looked up
+        set_cached_profile('default', stale, None)
+        self.assertEqual(get_cached_profile('default', self.admin.pk), stale)
+
+    def test_invalidation_backends_lookup(self):
+        # the configured cache aliases are only calculated once, not on every save
+        self.admin.save()
+        with mock.patch('allianceutils.auth.backends.get_backends') as get_backends:
+            self.admin.save()
+        get_backends.assert_not_called()
+
+
+class ProfileTypeTestCase(TestCase):
+    def setUp(self):
+        self.user = ProfileTypeUser.objects.create(name='user')
+        self.customer = ProfileTypeCustomerProfile.objects.create(name='customer', customer_details='c')
+        self.admin = ProfileTypeAdminProfile.objects.create(name='admin', admin_details='a')
+
+        self.profiles = {
+            self.user.pk: self.user,
+            self.customer.pk: self.customer,
+            self.admin.pk: self.admin,
+        }
+
+    def test_profile_type_saved(self):
+        self.assertEqual(
+            dict(ProfileTypeUser.objects.values_list('pk', 'profile_type')),
+            {
+                self.user.pk: '',
+                self.customer.pk: 'profiletypecustomerprofile',
+                self.admin.pk: 'profiletypeadminprofile',
+            }
+        )
+
+        # adding a profile to an existing user
+        ProfileTypeAdminProfile(profiletypeuser_ptr=self.user, name='user', admin_details='x').save_base(raw=False)
+        self.assertEqual(ProfileTypeUser.objects.get(pk=self.user.pk).profile_type, 'profiletypeadminprofile')
+        ProfileTypeUser.objects.filter(pk=self.user.pk).update(profile_type='')
+        ProfileTypeAdminProfile.objects.get(pk=self.user.pk).save(update_fields=['admin_details'])
+        self.assertEqual(ProfileTypeUser.objects.get(pk=self.user.pk).profile_type, 'profiletypeadminprofile')
+
+        # removing a profile but keeping the user
+        ProfileTypeAdminProfile.objects.get(pk=self.admin.pk).delete(keep_parents=True)
+        self.assertEqual(ProfileTypeUser.objects.get(pk=self.admin.pk).profile_type, '')
+
+    def test_profile_type_raw_save(self):
+        # loaddata saves each model in the inheritance chain separately with raw=True
+        user = ProfileTypeUser.objects.create(name='fixture')
+        ProfileTypeCustomerProfile(
+            profiletypeuser_ptr_id=user.pk,
+            customer_details='f',
+        ).save_base(raw=True)
+        self.assertEqual(ProfileTypeUser.objects.get(pk=user.pk).profile_type, 'profiletypecustomerprofile')
+
+    def test_update_profile_types(self):
+        ProfileTypeUser.objects.update(profile_type='')
+        ProfileTypeUser.objects.filter(pk=self.user.pk).update(profile_type='profiletypeadminprofile')
+        ProfileTypeUser.objects.all().update_profile_types()
+        self.assertEqual(
+            dict(ProfileTypeUser.objects.values_list('pk', 'profile_type')),
+            {
+                self.user.pk: '',
+                self.customer.pk: 'profiletypecustomerprofile',
+                self.admin.pk: 'profiletypeadminprofile',
+            }
+        )
+
+    def test_get_profile(self):
+        for user_id, original_profile in self.profiles.items():
+            with self.subTest(name=original_profile.name):
+                user = ProfileTypeUser.objects.get(pk=user_id)
+                # a single lookup on the matching table; no probing of other tables
+                with self.assertNumQueries(0 if type(original_profile) is ProfileTypeUser else 1):
+                    self.assertIs(type(original_profile), type(user.profile))
+
+                # two primary key lookups and no joins
+                with self.assertNumQueries(2 if type(original_profile) is not ProfileTypeUser else 1) as ctx:
+                    profile = ProfileTypeUser.profiles.get(pk=user_id)
+                    self.assertIs(type(original_profile), type(profile))
+                self.assertTrue(all('JOIN' not in query['sql'] for query in ctx.captured_queries[:1]))
+
+    def test_iterate_profiles(self):
+        # one query for users + one per profile table present
+        with self.assertNumQueries(3):
+            profiles = list(ProfileTypeUser.profiles.all())
+        self.assertEqual({p.pk: type(p) for p in profiles}, {pk: type(p) for pk, p in self.profiles.items()})
+
+        with self.assertNumQueries(2):
+            profiles = list(ProfileTypeUser.profiles.filter(pk__in=[self.user.pk, self.admin.pk]))
+        self.assertEqual({p.pk: type(p) for p in profiles}, {self.user.pk: ProfileTypeUser, self.admin.pk: ProfileTypeAdminProfile})
+
+        with self.assertNumQueries(3):
+            users = list(ProfileTypeUser.objects.prefetch_related_profiles())
+        with self.assertNumQueries(0):
+            self.assertEqual({u.pk: type(u.profile) for u in users}, {pk: type(p) for pk, p in self.profiles.items()})
+            customer = next(u for u in users if u.pk == self.customer.pk)
+            self.assertEqual(customer.profiletypecustomerprofile.customer_details, 'c')
+
+    def test_resolve_profiles(self):
+        users = list(ProfileTypeUser.objects.order_by('pk'))
+        # only the profile tables that users actually have profiles in are queried
+        with self.assertNumQueries(2):
+            profiles = ProfileTypeUser.resolve_profiles(users)
+        with self.assertNumQueries(0):
+            self.assertEqual([type(p) for p in profiles], [type(self.profiles[u.pk]) for u in users])
+
+        users = list(ProfileTypeUser.objects.filter(pk__in=[self.user.pk, self.admin.pk]))
+        with self.assertNumQueries(1):
+            ProfileTypeUser.resolve_profiles(users)
+
+    def test_iterator_profiles(self):
+        with self.assertNumQueries(1 + 1 + 1):
+            profiles = list(ProfileTypeUser.profiles.order_by('pk').iterator(chunk_size=2))
+        self.assertEqual([type(p) for p in profiles], [type(self.profiles[pk]) for pk in sorted(self.profiles)])
+
+    def test_values(self):
+        with self.assertNumQueries(1) as ctx:
+            values = list(ProfileTypeUser.profiles.order_by('pk').values('pk', 'customer_details', 'profile_type'))
+        self.assertEqual(
+            values,
+            [
+                {'pk': self.user.pk, 'customer_details': None, 'profile_type': ''},
+                {'pk': self.customer.pk, 'customer_details': 'c', 'profile_type': 'profiletypecustomerprofile'},
+                {'pk': self.admin.pk, 'customer_details': None, 'profile_type': 'profiletypeadminprofile'},
+            ],
+        )
+        # only the table that the requested field comes from is joined
+        self.assertEqual(ctx.captured_queries[0]['sql'].count('JOIN'), 1)
+
+    def test_union_profiles(self):
+        with self.assertNumQueries(1) as ctx:
+            profiles = list(ProfileTypeUser.objects.union_profiles())
+        self.assertEqual({p.pk: type(p) for p in profiles}, {pk: type(p) for pk, p in self.profiles.items()})
+        # branches are selected by profile type; no anti-joins needed
+        sql = ctx.captured_queries[0]['sql']
+        self.assertEqual(sql.count('JOIN'), len(ProfileTypeUser.related_profile_tables))
+        self.assertNotIn('EXISTS', sql)
+
+    def test_count_by_profile_type(self):
+        with self.assertNumQueries(1) as ctx:
+            counts = ProfileTypeUser.objects.count_by_profile_type()
+        self.assertEqual(counts, {'profiletypecustomerprofile': 1, 'profiletypeadminprofile': 1, '': 1})
+        self.assertNotIn('JOIN', ctx.captured_queries[0]['sql'])
+
+        # unknown (stale) profile types are ignored rather than failing
+        ProfileTypeUser.objects.filter(pk=self.admin.pk).update(profile_type='removedprofile')
+        with self.assertLogs('allianceutils', 'WARNING'):
+            counts = ProfileTypeUser.objects.count_by_profile_type()
+        self.assertEqual(counts, {'profiletypecustomerprofile': 1, 'profiletypeadminprofile': 0, '': 1})
+        # 1 for the user + probing each profile table in turn
+        with self.assertNumQueries(3):
+            profiles = ProfileTypeUser.resolve_profiles(ProfileTypeUser.objects.filter(pk=self.admin.pk))
+        self.assertIs(type(profiles[0]), ProfileTypeAdminProfile)
@@ -1,3 +1,5 @@
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
 
@@ -29,3 +31,10 @@ class Purchase(models.Model):
 
     def natural_key(self):
         return (self.customer.natural_key(),)
+
+
+class PurchaseNote(models.Model):
+    content_type = models.ForeignKey(to=ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    target = GenericForeignKey()
+    text = models.CharField(max_length=50)
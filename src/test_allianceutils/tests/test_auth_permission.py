@@ -0,0 +1,483 @@
+from __future__ import annotations
+
+try:
+    import rules
+except ImportError:
+    import unittest
+    raise unittest.SkipTest("django-rules is not installed")
+
+from decimal import Decimal
+import json
+from unittest import mock
+import warnings
+
+from django.contrib.auth import get_backends
+from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.contrib.auth.models import AnonymousUser
+from django.db.models import Q
+from django.http import HttpResponse
+from django.test import override_settings
+from django.test import RequestFactory
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.urls import clear_url_caches
+from django.urls import path
+from django.urls import resolve
+from django.views import View
+
+from allianceutils.auth.backends import MinimalModelBackend
+from allianceutils.auth.backends import PermissionMatrixBackendMixin
+from allianceutils.auth.permission import _permission_matrix
+from allianceutils.auth.permission import AmbiguousGlobalPermissionWarning
+from allianceutils.auth.permission import build_permission_matrix
+from allianceutils.auth.permission import clear_global_perms_cache
+from allianceutils.auth.permission import clear_permission_cache
+from allianceutils.auth.permission import clear_permission_matrix
+from allianceutils.auth.permission import get_objects_with_perms
+from allianceutils.auth.permission import get_role_global_perm
+from allianceutils.auth.permission import identify_global_perms
+from allianceutils.auth.permission import permission_cache
+from allianceutils.auth.permission import permission_timing
+from allianceutils.auth.permission import register_perm_filter
+from allianceutils.auth.permission import remove_perm_filter
+from allianceutils.auth.permission import reverse_if_probably_allowed
+from allianceutils.auth.permission import reverse_if_probably_allowed_many
+from allianceutils.middleware.permission_cache import PermissionCacheMiddleware
+from allianceutils.middleware.permission_timing import PermissionTimingMiddleware
+from allianceutils.rules import has_perm
+from test_allianceutils.tests.perm_check_user import PermissionCheckUser
+from test_allianceutils.tests.profile_auth.models import AdminProfile
+from test_allianceutils.tests.profile_auth.models import CustomerProfile
+from test_allianceutils.tests.viewset_permissions.models import NinjaTurtleModel
+
+
+@rules.predicate
+def _object_predicate(user, obj):
+    return True
+
+
+class GlobalPermView(PermissionRequiredMixin, View):
+    permission_required = 'test_allianceutils.global_perm'
+
+
+class ObjectPermView(PermissionRequiredMixin, View):
+    permission_required = 'test_allianceutils.object_perm'
+
+
+class PublicView(View):
+    pass
+
+
+urlpatterns = [
+    path('global/', GlobalPermView.as_view(), name='global'),
+    path('object/<int:pk>/', ObjectPermView.as_view(), name='object'),
+    path('public/', PublicView.as_view(), name='public'),
+    # the same name & argument structure but different views
+    path('shared/<int:pk>/', ObjectPermView.as_view(), name='shared'),
+    path('shared/<slug:pk>/', GlobalPermView.as_view(), name='shared'),
+]
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=[
+        'rules.permissions.ObjectPermissionBackend',
+        'django.contrib.auth.backends.ModelBackend',
+    ],
+)
+class RulesTestCase(SimpleTestCase):
+    def setUp(self):
+        clear_global_perms_cache()
+        self.addCleanup(clear_global_perms_cache)
+        rules.add_perm('test_allianceutils.global_perm', rules.is_authenticated)
+        rules.add_perm('test_allianceutils.object_perm', _object_predicate)
+        self.addCleanup(rules.remove_perm, 'test_allianceutils.global_perm')
+        self.addCleanup(rules.remove_perm, 'test_allianceutils.object_perm')
+
+
+class IdentifyGlobalPermsTestCase(RulesTestCase):
+    def test_identify_global_perms(self):
+        self.assertEqual(
+            identify_global_perms(['test_allianceutils.global_perm', 'test_allianceutils.object_perm']),
+            (['test_allianceutils.global_perm'], ['test_allianceutils.object_perm']),
+        )
+        self.assertEqual(identify_global_perms('test_allianceutils.object_perm'), ([], ['test_allianceutils.object_perm']))
+
+    def test_cache(self):
+        perms = ['test_allianceutils.global_perm', 'test_allianceutils.object_perm']
+        with mock.patch('allianceutils.auth.permission.get_backends', wraps=get_backends) as mock_get_backends:
+            expected = identify_global_perms(perms)
+            self.assertEqual(mock_get_backends.call_count, 1)
+            self.assertEqual(identify_global_perms(perms), expected)
+            self.assertEqual(mock_get_backends.call_count, 1)
+
+            # re-registering a rule invalidates it
+            rules.set_perm('test_allianceutils.global_perm', _object_predicate)
+            self.assertEqual(identify_global_perms(perms), ([], perms))
+            self.assertEqual(mock_get_backends.call_count, 2)
+
+        # changing backends invalidates everything
+        with override_settings(AUTHENTICATION_BACKENDS=['django.contrib.auth.backends.ModelBackend']):
+            with self.assertWarns(AmbiguousGlobalPermissionWarning):
+                self.assertEqual(identify_global_perms('test_allianceutils.object_perm'), (['test_allianceutils.object_perm'], []))
+        self.assertEqual(identify_global_perms('test_allianceutils.object_perm'), ([], ['test_allianceutils.object_perm']))
+
+    def test_ambiguous_warning(self):
+        with self.assertWarns(AmbiguousGlobalPermissionWarning):
+            self.assertEqual(identify_global_perms('test_allianceutils.unknown'), (['test_allianceutils.unknown'], []))
+
+        # only warns the first time
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertEqual(identify_global_perms('test_allianceutils.unknown'), (['test_allianceutils.unknown'], []))
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class ReverseIfProbablyAllowedTestCase(RulesTestCase):
+    def setUp(self):
+        super().setUp()
+        clear_url_caches()
+
+    def make_request(self, allowed_perms):
+        request = RequestFactory().get('/')
+        request.user = PermissionCheckUser(allowed_perms)
+        return request
+
+    def test_reverse_if_probably_allowed(self):
+        obj = object()
+        request = self.make_request([('test_allianceutils.global_perm', None)])
+        self.assertEqual(reverse_if_probably_allowed(request, 'global'), '/global/')
+        self.assertIsNone(reverse_if_probably_allowed(request, 'object', obj, kwargs={'pk': 1}))
+        self.assertEqual(reverse_if_probably_allowed(request, 'public'), '/public/')
+
+    def test_shared_viewname(self):
+        obj = object()
+        request = self.make_request([('test_allianceutils.global_perm', None)])
+        for _ in range(2):
+            self.assertEqual(reverse_if_probably_allowed(request, 'shared', obj, kwargs={'pk': 'slug'}), '/shared/slug/')
+            self.assertIsNone(reverse_if_probably_allowed(request, 'shared', obj, kwargs={'pk': 1}))
+
+    def test_reverse_if_probably_allowed_many(self):
+        obj1 = object()
+        obj2 = object()
+        request = self.make_request([
+            ('test_allianceutils.global_perm', None),
+            ('test_allianceutils.object_perm', obj2),
+        ])
+        specs = [
+            'global',
+            ('global',),
+            ('object', [1], None, obj1),
+            ('object', [2], None, obj2),
+            ('object', None, {'pk': 3}, obj1),
+            ('public', [], {}),
+        ]
+        with mock.patch('allianceutils.auth.permission.resolve', wraps=resolve) as mock_resolve:
+            urls = reverse_if_probably_allowed_many(request, specs)
+        self.assertEqual(urls, ['/global/', '/global/', None, '/object/2/', None, '/public/'])
+
+        # each view is only resolved once per argument structure
+        self.assertEqual(mock_resolve.call_count, 4)
+
+        # resolved views are remembered between calls until URLconfs are reloaded
+        with mock.patch('allianceutils.auth.permission.resolve', wraps=resolve) as mock_resolve:
+            self.assertEqual(reverse_if_probably_allowed_many(request, specs), urls)
+            self.assertEqual(mock_resolve.call_count, 0)
+            clear_url_caches()
+            self.assertEqual(reverse_if_probably_allowed_many(request, specs), urls)
+            self.assertEqual(mock_resolve.call_count, 4)
+
+        # each distinct permission check is only done once per call
+        self.assertEqual(request.user.checked_perms[:3], [
+            ('test_allianceutils.global_perm', None),
+            ('test_allianceutils.object_perm', obj1),
+            ('test_allianceutils.object_perm', obj2),
+        ])
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=[
+        'allianceutils.auth.backends.PermissionCacheBackend',
+        'rules.permissions.ObjectPermissionBackend',
+        'django.contrib.auth.backends.ModelBackend',
+    ],
+)
+class PermissionCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.checks = []
+
+        @rules.predicate
+        def counting_predicate(user, obj):
+            self.checks.append(obj)
+            return obj is not None and obj.allowed
+
+        rules.add_perm('test_allianceutils.counted_perm', counting_predicate)
+        self.addCleanup(rules.remove_perm, 'test_allianceutils.counted_perm')
+
+    def test_permission_cache(self):
+        user = AnonymousUser()
+        allowed = mock.Mock(allowed=True)
+        denied = mock.Mock(allowed=False)
+        perm = 'test_allianceutils.counted_perm'
+
+        # no caching outside of a permission_cache() block
+        self.assertTrue(user.has_perm(perm, allowed))
+        self.assertTrue(user.has_perm(perm, allowed))
+        self.assertEqual(self.checks, [allowed, allowed])
+
+        self.checks.clear()
+        with permission_cache():
+            self.assertTrue(user.has_perm(perm, allowed))
+            self.assertFalse(user.has_perm(perm, denied))
+            self.assertFalse(user.has_perm(perm))
+            with permission_cache():
+                self.assertTrue(AnonymousUser().has_perm(perm, allowed))
+                self.assertFalse(user.has_perm(perm, denied))
+                self.assertFalse(user.has_perm(perm))
+            self.assertEqual(self.checks, [allowed, denied, None])
+
+            # equal but distinct objects are checked separately
+            self.assertTrue(user.has_perm(perm, mock.Mock(allowed=True)))
+            self.assertEqual(len(self.checks), 4)
+
+            clear_permission_cache()
+            self.assertTrue(user.has_perm(perm, allowed))
+            self.assertEqual(len(self.checks), 5)
+
+        # cache is discarded at the end of the block
+        self.assertTrue(user.has_perm(perm, allowed))
+        self.assertEqual(len(self.checks), 6)
+
+    def test_middleware(self):
+        user = AnonymousUser()
+        obj = mock.Mock(allowed=True)
+
+        def view(request):
+            for _ in range(3):
+                self.assertTrue(user.has_perm('test_allianceutils.counted_perm', obj))
+            return HttpResponse()
+
+        middleware = PermissionCacheMiddleware(view)
+        middleware(RequestFactory().get('/'))
+        middleware(RequestFactory().get('/'))
+        self.assertEqual(self.checks, [obj, obj])
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=[
+        'rules.permissions.ObjectPermissionBackend',
+        'django.contrib.auth.backends.ModelBackend',
+    ],
+)
+class GetObjectsWithPermsTestCase(TestCase):
+    def setUp(self):
+        self.checks = []
+
+        @rules.predicate
+        def is_red(user, obj):
+            self.checks.append(obj)
+            return obj is not None and obj.color == 'red'
+
+        @rules.predicate
+        def is_big(user, obj):
+            self.checks.append(obj)
+            return obj is not None and obj.shell_size > 12
+
+        rules.add_perm('test_allianceutils.red_perm', is_red)
+        rules.add_perm('test_allianceutils.big_perm', is_big)
+        rules.add_perm('test_allianceutils.global_perm', rules.always_allow)
+        for perm in ('test_allianceutils.red_perm', 'test_allianceutils.big_perm', 'test_allianceutils.global_perm'):
+            self.addCleanup(rules.remove_perm, perm)
+
+        self.turtles = [
+            NinjaTurtleModel.objects.create(name=name, color=color, shell_size=Decimal(size))
+            for name, color, size in (
+                ('leonardo', 'blue', '12.5'),
+                ('raphael', 'red', '13.0'),
+                ('donatello', 'purple', '11.0'),
+                ('michelangelo', 'red', '11.5'),
+            )
+        ]
+        self.user = AnonymousUser()
+
+    def test_per_object_fallback(self):
+        leonardo, raphael, donatello, michelangelo = self.turtles
+        self.assertEqual(
+            get_objects_with_perms(self.user, 'test_allianceutils.red_perm', self.turtles),
+            {raphael, michelangelo},
+        )
+        # only remaining objects are checked for later permissions
+        self.checks.clear()
+        self.assertEqual(
+            get_objects_with_perms(self.user, ['test_allianceutils.red_perm', 'test_allianceutils.big_perm'], self.turtles),
+            {raphael},
+        )
+        self.assertEqual(self.checks, [None, *self.turtles, None, raphael, michelangelo])
+
+    def test_global_perm(self):
+        self.checks.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_objects_with_perms(self.user, 'test_allianceutils.global_perm', self.turtles),
+                set(self.turtles),
+            )
+
+    def test_perm_filter(self):
+        leonardo, raphael, donatello, michelangelo = self.turtles
+        register_perm_filter('test_allianceutils.red_perm', lambda user: Q(color='red'))
+        self.addCleanup(remove_perm_filter, 'test_allianceutils.red_perm')
+
+        self.checks.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                get_objects_with_perms(self.user, 'test_allianceutils.red_perm', self.turtles),
+                {raphael, michelangelo},
+            )
+        # only the global check is done
+        self.assertEqual(self.checks, [None])
+
+        # querysets work too
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                get_objects_with_perms(self.user, 'test_allianceutils.red_perm', NinjaTurtleModel.objects.all()),
+                {raphael, michelangelo},
+            )
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class PermissionTimingTestCase(RulesTestCase):
+    def make_request(self):
+        request = RequestFactory().get('/')
+        request.user = PermissionCheckUser([('test_allianceutils.global_perm', None)])
+        return request
+
+    def test_permission_timing(self):
+        request = self.make_request()
+        predicate = has_perm('test_allianceutils.global_perm') & has_perm('test_allianceutils.global_perm')
+        with permission_timing() as timer:
+            reverse_if_probably_allowed_many(request, ['global', 'global', ('object', [1], None, object())])
+            predicate.test(request.user)
+            with permission_timing() as inner_timer:
+                self.assertIs(inner_timer, timer)
+                predicate.test(request.user)
+
+        report = timer.get_report()
+        self.assertEqual(report['count'], 4)
+        self.assertEqual((report['cache_hits'], report['cache_misses']), (3, 4))
+        self.assertEqual(report['cache_hit_rate'], 0.429)
+        self.assertEqual(
+            {(slowest['perm'], slowest['count']) for slowest in report['slowest']},
+            {('test_allianceutils.global_perm', 3), ('test_allianceutils.object_perm', 1)},
+        )
+
+        # nothing is recorded outside the block
+        reverse_if_probably_allowed_many(request, ['global'])
+        self.assertEqual(timer.count, 4)
+
+    def test_middleware(self):
+        request = self.make_request()
+
+        def view(request):
+            reverse_if_probably_allowed_many(request, ['global', ('object', [1], None, object())])
+            return HttpResponse()
+
+        middleware = PermissionTimingMiddleware(view)
+        with override_settings(DEBUG=True):
+            response = middleware(request)
+        report = json.loads(response['X-Permission-Timing'])
+        self.assertEqual(report['count'], 2)
+
+        with self.assertLogs('allianceutils', 'INFO') as logs:
+            response = middleware(request)
+        self.assertNotIn('X-Permission-Timing', response)
+        self.assertEqual(logs.records[0].permission_timing['count'], 2)
+
+        # requests with no checks aren't reported
+        middleware = PermissionTimingMiddleware(lambda request: HttpResponse())
+        with override_settings(DEBUG=True):
+            self.assertNotIn('X-Permission-Timing', middleware(request))
+
+
+class MatrixBackend(PermissionMatrixBackendMixin, MinimalModelBackend):
+    permission_matrix_perms = {'test_allianceutils.admin_perm'}
+
+
+class DenyingMatrixBackend(MatrixBackend):
+    permission_matrix_denies = True
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=[
+        'test_allianceutils.tests.test_auth_permission.MatrixBackend',
+        'rules.permissions.ObjectPermissionBackend',
+    ],
+)
+class PermissionMatrixTestCase(RulesTestCase):
+    def setUp(self):
+        super().setUp()
+        clear_permission_matrix()
+        self.addCleanup(clear_permission_matrix)
+        self.checks = []
+
+        @rules.predicate
+        def is_admin(user):
+            self.checks.append(user)
+            return isinstance(user, AdminProfile)
+
+        rules.add_perm('test_allianceutils.admin_perm', is_admin)
+        self.addCleanup(rules.remove_perm, 'test_allianceutils.admin_perm')
+
+    def test_get_role_global_perm(self):
+        self.assertTrue(get_role_global_perm(AdminProfile, 'test_allianceutils.admin_perm'))
+        self.assertFalse(get_role_global_perm(CustomerProfile, 'test_allianceutils.admin_perm'))
+        self.assertTrue(get_role_global_perm(CustomerProfile, 'test_allianceutils.global_perm'))
+        # object & unknown permissions aren't in the matrix
+        self.assertIsNone(get_role_global_perm(AdminProfile, 'test_allianceutils.object_perm'))
+        self.assertIsNone(get_role_global_perm(AdminProfile, 'test_allianceutils.unknown'))
+        self.assertEqual(len(self.checks), 2)
+
+        # re-registering a rule invalidates it
+        rules.set_perm('test_allianceutils.admin_perm', rules.is_superuser)
+        self.assertFalse(get_role_global_perm(AdminProfile, 'test_allianceutils.admin_perm'))
+
+    def test_backend(self):
+        build_permission_matrix([AdminProfile, CustomerProfile], ['test_allianceutils.admin_perm'])
+        self.assertEqual(len(self.checks), 2)
+        self.checks.clear()
+
+        admin = AdminProfile(email='admin@example.com')
+        customer = CustomerProfile(email='customer@example.com')
+        for i in range(3):
+            self.assertTrue(admin.has_perm('test_allianceutils.admin_perm'))
+        self.assertEqual(self.checks, [])
+
+        # denials fall through to the rules backend
+        self.assertFalse(customer.has_perm('test_allianceutils.admin_perm'))
+        self.assertEqual(self.checks, [customer])
+
+        self.checks.clear()
+        with override_settings(AUTHENTICATION_BACKENDS=[
+            'test_allianceutils.tests.test_auth_permission.DenyingMatrixBackend',
+            'rules.permissions.ObjectPermissionBackend',
+        ]):
+            self.assertFalse(customer.has_perm('test_allianceutils.admin_perm'))
+            self.assertEqual(len(self.checks), 1)  # rebuilding the matrix after the backends changed
+            self.assertFalse(customer.has_perm('test_allianceutils.admin_perm'))
+            self.assertEqual(len(self.checks), 1)
+
+    def test_field_dependent_rules(self):
+        # rules that read field values aren't listed in permission_matrix_perms so aren't answered from the matrix
+        rules.add_perm('test_allianceutils.staff_perm', rules.is_staff)
+        rules.add_perm('test_allianceutils.not_staff_perm', ~rules.is_staff)
+        self.addCleanup(rules.remove_perm, 'test_allianceutils.staff_perm')
+        self.addCleanup(rules.remove_perm, 'test_allianceutils.not_staff_perm')
+
+        staff = AdminProfile(email='staff@example.com', is_staff=True)
+        for backend in ('MatrixBackend', 'DenyingMatrixBackend'):
+            with override_settings(AUTHENTICATION_BACKENDS=[
+                f'test_allianceutils.tests.test_auth_permission.{backend}',
+                'rules.permissions.ObjectPermissionBackend',
+            ]):
+                self.assertTrue(staff.has_perm('test_allianceutils.staff_perm'))
+                self.assertFalse(staff.has_perm('test_allianceutils.not_staff_perm'))
+        self.assertNotIn((AdminProfile, 'test_allianceutils.staff_perm'), _permission_matrix)
+        self.assertNotIn((AdminProfile, 'test_allianceutils.not_staff_perm'), _permission_matrix)
@@ -4,11 +4,21 @@ except ImportError:
     import unittest
     raise unittest.SkipTest("djangorestframework is not installed")
 
+from django.contrib.contenttypes.models import ContentType
+from django.http import QueryDict
 from django.test import TestCase
+from rest_framework import serializers
+from rest_framework import viewsets
+from rest_framework.permissions import AllowAny
 from rest_framework.serializers import ModelSerializer
+from rest_framework.test import APIRequestFactory
 
 from allianceutils.api import SerializerOptInFieldsMixin
+from allianceutils.api import SerializerOptInFieldsViewSetMixin
 from test_allianceutils.tests.profile_auth.models import User
+from test_allianceutils.tests.serializers.models import Customer
+from test_allianceutils.tests.serializers.models import Purchase
+from test_allianceutils.tests.serializers.models import PurchaseNote
 
 
 class UserSerializer(SerializerOptInFieldsMixin, ModelSerializer):
@@ -18,6 +28,31 @@ class UserSerializer(SerializerOptInFieldsMixin, ModelSerializer):
         opt_in_only_fields = ("is_active", "is_staff")
 
 
+class CountingField(serializers.CharField):
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingField.instances += 1
+        super().__init__(*args, **kwargs)
+
+
+class CountingUserSerializer(SerializerOptInFieldsMixin, ModelSerializer):
+    full_name = CountingField(source="email")
+
+    class Meta:
+        model = User
+        fields = ("id", "email", "full_name")
+        opt_in_only_fields = ("full_name",)
+
+
+class CountingQueryParams(dict):
+    lookups = 0
+
+    def __contains__(self, item):
+        CountingQueryParams.lookups += 1
+        return super().__contains__(item)
+
+
 class MockRequest:
     def __init__(self, query_params):
         self.query_params = query_params
@@ -139,3 +174,253 @@ class OptinFieldMixinTestcase(TestCase):
         self.assertTrue("first_name" not in serializer.fields)
         self.assertTrue("is_active" not in serializer.fields)
         self.assertTrue("is_staff" in serializer.fields)
+
+    def test_query_dict(self):
+        context = {"request": MockRequest(QueryDict("include_fields=first_name&include_fields=email"))}
+        serializer = UserSerializer(context=context)
+        self.assertEqual(set(serializer.fields), {"id", "first_name", "email"})
+
+        # an empty parameter is ignored
+        context = {"request": MockRequest(QueryDict("include_fields="))}
+        serializer = UserSerializer(context=context)
+        self.assertEqual(set(serializer.fields), {"id", "first_name", "last_name", "email"})
+
+    def test_excluded_fields_not_constructed(self):
+        CountingField.instances = 0
+        serializer = CountingUserSerializer(context={"request": MockRequest({})})
+        self.assertEqual(set(serializer.fields), {"id", "email"})
+        self.assertEqual(CountingField.instances, 0)
+
+        serializer = CountingUserSerializer(context={"request": MockRequest({"opt_in_fields": "full_name"})})
+        self.assertEqual(set(serializer.fields), {"id", "email", "full_name"})
+        self.assertEqual(CountingField.instances, 1)
+
+    def test_requested_fields_parsed_once(self):
+        users = [User(id=1, email="a@example.com"), User(id=2, email="b@example.com")]
+        CountingQueryParams.lookups = 0
+        context = {"request": MockRequest(CountingQueryParams({"include_fields": "email"}))}
+        data = UserSerializer(users, many=True, context=context).data
+        self.assertEqual([dict(row) for row in data], [{"id": 1, "email": "a@example.com"}, {"id": 2, "email": "b@example.com"}])
+        # include_fields and opt_in_fields are each looked up once
+        self.assertEqual(CountingQueryParams.lookups, 2)
+
+    def test_context_not_modified(self):
+        request = MockRequest({"include_fields": "email"})
+        context = {"request": request}
+        serializer = UserSerializer(context=context)
+        self.assertEqual(set(serializer.fields), {"id", "email"})
+        self.assertEqual(context, {"request": request})
+
+        # the same context can be reused with a different request
+        context["request"] = MockRequest({"include_fields": "first_name"})
+        self.assertEqual(set(UserSerializer(context=context).fields), {"id", "first_name"})
+
+
+class CustomerSerializer(SerializerOptInFieldsMixin, ModelSerializer):
+    class Meta:
+        model = Customer
+        fields = ("id", "username", "num")
+
+
+class PurchaseSerializer(SerializerOptInFieldsMixin, ModelSerializer):
+    customer = CustomerSerializer()
+    customer_label = serializers.CharField(source="customer.label")
+    method = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Purchase
+        fields = ("id", "customer", "customer_id", "customer_label", "method")
+        opt_in_only_fields = ("customer_label", "method")
+
+    def get_method(self, obj):
+        return "method"
+
+
+class OptInCustomerSerializer(SerializerOptInFieldsMixin, ModelSerializer):
+    class Meta:
+        model = Customer
+        fields = ("id", "username", "num")
+        opt_in_only_fields = ("num",)
+
+
+class PurchaseOptInCustomerSerializer(SerializerOptInFieldsMixin, ModelSerializer):
+    customer = OptInCustomerSerializer()
+
+    class Meta:
+        model = Purchase
+        fields = ("id", "customer")
+
+
+class CustomerPurchasesSerializer(SerializerOptInFieldsMixin, ModelSerializer):
+    purchase_set = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+
+    class Meta:
+        model = Customer
+        fields = ("id", "username", "purchase_set")
+
+
+class TargetField(serializers.Field):
+    def to_representation(self, value):
+        return value.pk
+
+
+class PurchaseNoteSerializer(SerializerOptInFieldsMixin, ModelSerializer):
+    target = TargetField(read_only=True)
+
+    class Meta:
+        model = PurchaseNote
+        fields = ("id", "target")
+
+
+class PurchaseViewSet(SerializerOptInFieldsViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Purchase.objects.order_by("pk")
+    serializer_class = PurchaseSerializer
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+
+class CustomerViewSet(SerializerOptInFieldsViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Customer.objects.order_by("pk")
+    serializer_class = CustomerPurchasesSerializer
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+
+class PurchaseNoteViewSet(SerializerOptInFieldsViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = PurchaseNote.objects.order_by("pk")
+    serializer_class = PurchaseNoteSerializer
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+
+class NestedOptInSerializerTestCase(TestCase):
+    def test_nested_uses_own_context(self):
+        # nested serializers don't see the root request's include_fields / opt_in_fields
+        context = {"request": MockRequest({"include_fields": "customer", "opt_in_fields": "num"})}
+        serializer = PurchaseOptInCustomerSerializer(context=context)
+        self.assertEqual(set(serializer.fields), {"id", "customer"})
+        self.assertEqual(set(serializer.fields["customer"].fields), {"id", "username"})
+
+        # unless they are given their own context
+        serializer = OptInCustomerSerializer(context={"opt_in_fields": "num"})
+        self.assertEqual(set(serializer.fields), {"id", "username", "num"})
+
+
+class OptInFieldsViewSetMixinTestCase(TestCase):
+    def setUp(self):
+        for i in range(3):
+            customer = Customer.objects.create(username=f"c{i}", label=f"label{i}", num=i)
+            Purchase.objects.create(customer=customer)
+            Purchase.objects.create(customer=customer)
+
+    def get_queryset(self, viewset, query_string="", method="get"):
+        view = viewset(action="list", action_map={method: "list"}, format_kwarg=None)
+        view.request = view.initialize_request(getattr(APIRequestFactory(), method)("/?" + query_string))
+        return view.get_queryset()
+
+    def get_data(self, viewset, query_string=""):
+        request = APIRequestFactory().get("/?" + query_string)
+        return viewset.as_view({"get": "list"})(request).data
+
+    def test_only(self):
+        queryset = self.get_queryset(PurchaseViewSet, "include_fields=customer_id")
+        self.assertEqual(queryset.query.deferred_loading, ({"id", "customer"}, False))
+        self.assertFalse(queryset.query.select_related)
+        with self.assertNumQueries(1):
+            data = self.get_data(PurchaseViewSet, "include_fields=customer_id")
+        self.assertEqual(set(data[0]), {"id", "customer_id"})
+
+    def test_select_related(self):
+        queryset = self.get_queryset(PurchaseViewSet)
+        self.assertEqual(queryset.query.select_related, {"customer": {}})
+        self.assertEqual(
+            queryset.query.deferred_loading,
+            ({"id", "customer", "customer__id", "customer__username", "customer__num"}, False),
+        )
+        with self.assertNumQueries(1):
+            data = self.get_data(PurchaseViewSet)
+        self.assertEqual(dict(data[0]["customer"]), {"id": data[0]["customer_id"], "username": "c0", "num": 0})
+
+        # related object used without a nested serializer loads all of its fields
+        with self.assertNumQueries(1):
+            data = self.get_data(PurchaseViewSet, "include_fields=customer_label")
+        self.assertEqual(data[0]["customer_label"], "label0")
+
+    def test_existing_select_related(self):
+        class SelectAllViewSet(viewsets.ReadOnlyModelViewSet):
+            def get_queryset(self):
+                return Purchase.objects.select_related().order_by("pk")
+
+        class SelectAllPurchaseViewSet(SerializerOptInFieldsViewSetMixin, SelectAllViewSet):
+            serializer_class = PurchaseSerializer
+            permission_classes = [AllowAny]
+            authentication_classes = []
+
+        class SelectPersonPurchaseViewSet(PurchaseViewSet):
+            queryset = Purchase.objects.select_related("customer__person_ptr").order_by("pk")
+
+        # select_related() with no arguments isn't narrowed to the serializer's lookups
+        queryset = self.get_queryset(SelectAllPurchaseViewSet)
+        self.assertIs(queryset.query.select_related, True)
+        self.assertEqual(queryset.query.deferred_loading, (frozenset(), True))
+        with self.assertNumQueries(1):
+            data = self.get_data(SelectAllPurchaseViewSet, "opt_in_fields=customer_label")
+        self.assertEqual(data[0]["customer_label"], "label0")
+
+        # select_related() lookups are merged
+        queryset = self.get_queryset(SelectPersonPurchaseViewSet)
+        self.assertEqual(queryset.query.select_related, {"customer": {"person_ptr": {}}})
+
+    def test_unknown_fields(self):
+        queryset = self.get_queryset(PurchaseViewSet, "opt_in_fields=method")
+        self.assertEqual(queryset.query.deferred_loading, (frozenset(), True))
+        self.assertEqual(queryset.query.select_related, {"customer": {}})
+
+    def test_prefetch_related(self):
+        queryset = self.get_queryset(CustomerViewSet)
+        self.assertEqual(queryset._prefetch_related_lookups, ("purchase_set",))
+        with self.assertNumQueries(2):
+            data = self.get_data(CustomerViewSet)
+        self.assertEqual(len(data[0]["purchase_set"]), 2)
+
+    def test_write_requests_unchanged(self):
+        queryset = self.get_queryset(PurchaseViewSet, "include_fields=customer_id", method="post")
+        self.assertEqual(queryset.query.deferred_loading, (frozenset(), True))
+        self.assertFalse(queryset.query.select_related)
+
+    def test_generic_foreign_key(self):
+        for purchase in Purchase.objects.all():
+            PurchaseNote.objects.create(target=purchase, text="note")
+        queryset = self.get_queryset(PurchaseNoteViewSet)
+        self.assertEqual(queryset._prefetch_related_lookups, ("target",))
+        self.assertEqual(queryset.query.deferred_loading, ({"id", "content_type", "object_id"}, False))
+        # notes, content type (cached after the first request) & purchases
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(3):
+            data = self.get_data(PurchaseNoteViewSet)
+        self.assertEqual([row["target"] for row in data], list(Purchase.objects.order_by("pk").values_list("pk", flat=True)))
+
+    def test_lookups_cached(self):
+        serializers_built = []
+
+        class CachedPurchaseViewSet(PurchaseViewSet):
+            def get_serializer(self, *args, **kwargs):
+                serializers_built.append(args)
+                return super().get_serializer(*args, **kwargs)
+
+        self.get_queryset(CachedPurchaseViewSet, "include_fields=customer_id")
+        self.assertEqual(len(serializers_built), 1)
+        queryset = self.get_queryset(CachedPurchaseViewSet, "include_fields=customer_id")
+        self.assertEqual(len(serializers_built), 1)
+        self.assertEqual(queryset.query.deferred_loading, ({"id", "customer"}, False))
+
+        # different fields requested
+        queryset = self.get_queryset(CachedPurchaseViewSet)
+        self.assertEqual(len(serializers_built), 2)
+        self.assertEqual(queryset.query.select_related, {"customer": {}})
+
+        # caching disabled
+        CachedPurchaseViewSet.get_serializer_lookups_cache_key = lambda self: None
+        self.get_queryset(CachedPurchaseViewSet)
+        self.get_queryset(CachedPurchaseViewSet)
+        self.assertEqual(len(serializers_built), 4)
@@ -5,7 +5,9 @@ except ImportError:
     raise unittest.SkipTest("djangorestframework is not installed")
 
 from unittest.mock import Mock
+from unittest.mock import patch
 
+from django.core.exceptions import ImproperlyConfigured
 from django.test import override_settings
 from django.test import TestCase
 
@@ -71,3 +73,51 @@ class PermissionTestCase(TestCase):
 
         with self.assertRaises(AssertionError):
             SimpleDjangoObjectPermissions().has_object_permission(request, view, obj)
+
+    def test_object_permission_consistency_check(self):
+        """
+        Test SimpleDjangoObjectPermissions.consistency_check modes
+        """
+        checks = []
+        user = Mock()
+        def has_perm(permission_required, obj=None):
+            checks.append(obj)
+            return True
+        user.has_perm = has_perm
+        request = Mock()
+        request.user = user
+        view = Mock(spec=['permission_required'])
+        view.permission_required = 'test_allianceutils.object_perm'
+        obj = Mock()
+
+        def check(consistency_check, **kwargs):
+            permission = SimpleDjangoObjectPermissions()
+            permission.consistency_check = consistency_check
+            for k, v in kwargs.items():
+                setattr(permission, k, v)
+            checks.clear()
+            return permission.has_object_permission(request, view, obj)
+
+        with patch('allianceutils.api.permissions.identify_global_perms', return_value=([], [view.permission_required])):
+            # stops at the first successful check, starting with the object permission
+            self.assertTrue(check('never'))
+            self.assertEqual(checks, [obj])
+            self.assertTrue(check('debug'))
+            self.assertEqual(checks, [obj])
+            self.assertTrue(check('sample', consistency_check_sample_rate=0))
+            self.assertEqual(checks, [obj])
+
+            with self.assertRaises(AssertionError):
+                check('sample', consistency_check_sample_rate=1)
+            with override_settings(DEBUG=True):
+                with self.assertRaises(AssertionError):
+                    check('debug')
+            with override_settings(SIMPLE_OBJECT_PERMISSIONS_CONSISTENCY_CHECK='debug'):
+                self.assertTrue(check(None))
+                self.assertEqual(checks, [obj])
+            with self.assertRaises(ImproperlyConfigured):
+                check('sometimes')
+
+        with patch('allianceutils.api.permissions.identify_global_perms', return_value=([view.permission_required], [])):
+            self.assertTrue(check('never'))
+            self.assertEqual(checks, [None])
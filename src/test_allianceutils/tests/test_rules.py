@@ -0,0 +1,49 @@
+try:
+    import rules
+except ImportError:
+    import unittest
+    raise unittest.SkipTest("django-rules is not installed")
+
+from django.test import SimpleTestCase
+
+from allianceutils.rules import has_any_perms
+from allianceutils.rules import has_perm
+from allianceutils.rules import has_perms
+from test_allianceutils.tests.perm_check_user import PermissionCheckUser
+
+
+class RulesTestCase(SimpleTestCase):
+    def test_predicates(self):
+        user = PermissionCheckUser(['app.a', 'app.b'])
+        self.assertTrue(has_perm('app.a').test(user))
+        self.assertFalse(has_perm('app.c').test(user))
+        self.assertTrue(has_perms(['app.a', 'app.b']).test(user))
+        self.assertFalse(has_perms(['app.a', 'app.c']).test(user))
+        self.assertTrue(has_any_perms(['app.c', 'app.a']).test(user))
+        self.assertFalse(has_any_perms(['app.c', 'app.d']).test(user))
+
+        # can also be called directly
+        self.assertTrue(has_perm('app.a')(user))
+
+        with self.assertRaises(ValueError):
+            has_perms('app.a')
+
+    def test_interning(self):
+        self.assertIs(has_perm('app.a'), has_perm('app.a'))
+        self.assertIs(has_perms(['app.a', 'app.b']), has_perms(('app.a', 'app.b')))
+        self.assertIsNot(has_perms(['app.a', 'app.b']), has_any_perms(['app.a', 'app.b']))
+        self.assertEqual(str(has_any_perms(['app.a', 'app.b'])), 'has_any_perms:app.a,app.b')
+
+        obj = object()
+        self.assertIsNot(has_perm('app.a', obj), has_perm('app.a', obj))
+
+    def test_memoization(self):
+        user = PermissionCheckUser(['app.b'])
+        predicate = (has_perm('app.a') & has_perm('app.b')) | has_any_perms(['app.a', 'app.b', 'app.c'])
+        self.assertTrue(predicate.test(user))
+        # app.a is only checked once; has_any_perms stops once app.b passes
+        self.assertEqual(user.checked_perms, [('app.a', None), ('app.b', None)])
+
+        # memoization only lasts for a single invocation
+        self.assertTrue(predicate.test(user))
+        self.assertEqual(user.checked_perms, [('app.a', None), ('app.b', None)] * 2)
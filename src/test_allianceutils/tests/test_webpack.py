@@ -3,6 +3,7 @@ from __future__ import annotations
 from allianceutils.util.strtobool import strtobool
 import os
 from pathlib import Path
+import tempfile
 from typing import Any
 import unittest
 
@@ -10,8 +11,13 @@ from django.conf import settings
 from django.template import Context
 from django.template import Template
 from django.test import override_settings
+from django.test import RequestFactory
 from django.test import SimpleTestCase
 
+from allianceutils.webpack import clear_precompressed_index
+from allianceutils.webpack import get_precompressed_index
+from allianceutils.webpack import serve_precompressed
+
 # data that is in the webpack
 stats_dev_root = 'http://0.0.0.0:3011/'
 stats_dev = {
@@ -191,3 +197,83 @@ class AllianceBundleTestCase(SimpleTestCase):
         self.check_tag(cfg, 'combined', 'js', script_no_query % url('combined_js'))
         self.check_tag(cfg, 'cssonly', 'js', '')
         self.check_tag(cfg, 'jsonly', 'js', script_no_query % url('jsonly_js'))
+
+
+class PrecompressedTestCase(SimpleTestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.addCleanup(clear_precompressed_index)
+        clear_precompressed_index()
+
+        self.root = Path(tmp_dir.name)
+        files = {
+            'combined.HASH.bundle.js': b'js',
+            'combined.HASH.bundle.js.br': b'js-br',
+            'combined.HASH.bundle.js.gz': b'js-gz',
+            'combined.HASH.bundle.css': b'css',
+            'combined.HASH.bundle.css.gz': b'css-gz',
+            'jsonly.HASH.bundle.js': b'js',
+        }
+        for name, content in files.items():
+            Path(self.root, name).write_bytes(content)
+
+    def render(self, bundle, extension, accept_encoding=None):
+        request = RequestFactory().get('/')
+        if accept_encoding is not None:
+            request.META['HTTP_ACCEPT_ENCODING'] = accept_encoding
+        with override_settings(**make_settings(PRECOMPRESSED_ROOT=str(self.root))):
+            tpl = Template(f'{{% load alliance_webpack %}}{{% render_entry_point "{bundle}" "{extension}" config="prod" %}}')
+            return tpl.render(Context({'request': request}))
+
+    def test_index(self):
+        self.assertEqual(get_precompressed_index(self.root), {
+            'combined.HASH.bundle.js': frozenset({'br', 'gzip'}),
+            'combined.HASH.bundle.css': frozenset({'gzip'}),
+        })
+
+        # the index is only built once
+        Path(self.root, 'jsonly.HASH.bundle.js.br').write_bytes(b'js-br')
+        self.assertNotIn('jsonly.HASH.bundle.js', get_precompressed_index(self.root))
+        clear_precompressed_index()
+        self.assertIn('jsonly.HASH.bundle.js', get_precompressed_index(self.root))
+
+    def test_render_entry_point(self):
+        def url(filename):
+            return stats_prod_root + filename
+
+        self.assertEqual(self.render('combined', 'js'), script % url('combined.HASH.bundle.js'))
+        self.assertEqual(self.render('combined', 'js', 'gzip, deflate, br'), script % url('combined.HASH.bundle.js.br'))
+        self.assertEqual(self.render('combined', 'js', 'gzip, br;q=0'), script % url('combined.HASH.bundle.js.gz'))
+        # * doesn't override an explicit q=0
+        self.assertEqual(self.render('combined', 'js', 'br;q=0, *'), script % url('combined.HASH.bundle.js.gz'))
+        self.assertEqual(self.render('combined', 'js', 'br;q=0, gzip;q=0, *'), script % url('combined.HASH.bundle.js'))
+        self.assertEqual(self.render('combined', 'js', '*'), script % url('combined.HASH.bundle.js.br'))
+        self.assertEqual(self.render('combined', 'js', 'identity'), script % url('combined.HASH.bundle.js'))
+        self.assertEqual(self.render('combined', 'css', 'br, gzip'), link % url('combined.HASH.bundle.css.gz'))
+        self.assertEqual(self.render('jsonly', 'js', 'br, gzip'), script % url('jsonly.HASH.bundle.js'))
+
+    def serve(self, path, **headers):
+        response = serve_precompressed(RequestFactory().get('/', **headers), path, self.root)
+        self.addCleanup(response.close)
+        return response
+
+    def test_serve(self):
+
+        # explicit variant
+        response = self.serve('combined.HASH.bundle.js.br')
+        self.assertEqual(b''.join(response.streaming_content), b'js-br')
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(response.headers['Content-Type'], 'text/javascript')
+
+        # negotiated from the uncompressed path
+        response = self.serve('combined.HASH.bundle.js', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(b''.join(response.streaming_content), b'js-gz')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+        # no acceptable variant
+        response = self.serve('combined.HASH.bundle.js')
+        self.assertEqual(b''.join(response.streaming_content), b'js')
+        self.assertNotIn('Content-Encoding', response.headers)
@@ -7,21 +7,31 @@ except ImportError:
 from decimal import Decimal
 from typing import Optional
 from typing import Set
+from unittest.mock import patch
 
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import Permission
+from django.db import connection
 from django.db import transaction
+from django.db.models import Q
 from django.test import Client
 from django.test import modify_settings
 from django.test import override_settings
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.routers import SimpleRouter
 from rest_framework.test import APIClient
 from rest_framework.test import APIRequestFactory
 from rest_framework.test import force_authenticate
 
 from allianceutils.api.permissions import GenericDjangoViewsetPermissions
+from allianceutils.api.permissions import register_viewset_permissions
+from allianceutils.api.routers import ViewsetPermissionsRouterMixin
+from allianceutils.auth.permission import register_perm_filter
+from allianceutils.auth.permission import remove_perm_filter
 from test_allianceutils.tests.profile_auth.models import User
 from test_allianceutils.tests.viewset_permissions.models import NinjaTurtleModel
 from test_allianceutils.tests.viewset_permissions.models import SenseiRatModel
@@ -215,4 +225,152 @@ class ViewsetPermissionsTestCase(TestCase):
         test_methods("view_ninjaturtlemodel")  # should fail; perm lookup would hit SenseiRat who is going to say no
         test_methods("view_senseiratmodel", SenseiRatModel, {"view"})  # should succeed with permission from SenseiRat
 
+    def test_filtered_list_viewset(self):
+        """
+        Test GenericDjangoViewsetPermissions with PermissionQuerySetFilterMixin
+        """
+        NinjaTurtleModel.objects.create(name="raphael", color="red", shell_size=Decimal("11.0"))
+        NinjaTurtleModel.objects.create(name="donatello", color="purple", shell_size=Decimal("12.5"))
+        perm = "viewset_permissions.view_ninjaturtlemodel"
+        client = APIClient()
+        client.force_login(self.user)
+
+        def get_names():
+            response = client.get(reverse('permissions:filtered-list'))
+            if response.status_code != 200:
+                return response.status_code
+            return [turtle["name"] for turtle in response.json()]
+
+        # no global permission and no filter
+        self.assertEqual(get_names(), 403)
+
+        register_perm_filter(perm)(lambda user: Q(color="red"))
+        self.addCleanup(remove_perm_filter, perm)
+        self.assertEqual(get_names(), ["leonardo", "raphael"])
+
+        # filtering is done in a single query
+        with CaptureQueriesContext(connection) as queries:
+            get_names()
+        self.assertEqual(len([q for q in queries if "viewset_permissions_ninjaturtlemodel" in q["sql"]]), 1)
+
+        # detail views are unaffected
+        response = client.get(reverse('permissions:filtered-detail', kwargs={"pk": self.turtle.id}))
+        self.assertEqual(response.status_code, 403)
+
+        # a filter doesn't grant actions that don't go through filter_queryset()
+        add_perm = "viewset_permissions.add_ninjaturtlemodel"
+        register_perm_filter(add_perm)(lambda user: Q(color="red"))
+        self.addCleanup(remove_perm_filter, add_perm)
+        response = client.post(
+            reverse('permissions:filtered-list'),
+            {"name": "splinter", "color": "red", "shell_size": "10.0"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(NinjaTurtleModel.objects.filter(name="splinter").exists())
+
+        # global permission returns everything
+        self.grant_permission("view_ninjaturtlemodel")
+        self.assertEqual(get_names(), ["leonardo", "raphael", "donatello"])
+
+    @modify_settings(
+        AUTHENTICATION_BACKENDS={
+            "append": 'test_allianceutils.tests.viewset_permissions.tests.IgnoreObjectsBackend',
+        }
+    )
+    def test_permissions_for_action_cache(self):
+        factory = APIRequestFactory()
+        self.grant_permission("view_ninjaturtlemodel")
+        get_queryset_calls = []
+
+        class CachedPermissions(GenericDjangoViewsetPermissions):
+            cache_permissions_for_action = True
+
+        def make_viewset(permission_class):
+            class CountingViewSet(viewsets.ModelViewSet):
+                serializer_class = NinjaTurtleSerializer
+                permission_classes = [permission_class]
+
+                def get_queryset(self):
+                    get_queryset_calls.append(self.action)
+                    return NinjaTurtleModel.objects.all()
+
+            return CountingViewSet
+
+        def request(viewset, action, **kwargs):
+            request = factory.get("")
+            force_authenticate(request, user=self.user)
+            response = viewset.as_view({"get": action})(request, **kwargs).render()
+            self.assertEqual(response.status_code, 200)
+
+        # not cached by default
+        viewset = make_viewset(GenericDjangoViewsetPermissions)
+        for i in range(2):
+            get_queryset_calls.clear()
+            request(viewset, "list")
+            self.assertEqual(get_queryset_calls, ["list", "list"])
+
+        viewset = make_viewset(CachedPermissions)
+        get_queryset_calls.clear()
+        request(viewset, "list")
+        request(viewset, "retrieve", pk=self.turtle.pk)
+        self.assertEqual(get_queryset_calls, ["list", "list", "retrieve", "retrieve"])
+
+        # permission lookups are cached for each viewset class & action
+        get_queryset_calls.clear()
+        request(viewset, "list")
+        request(viewset, "retrieve", pk=self.turtle.pk)
+        self.assertEqual(get_queryset_calls, ["list", "retrieve"])
+
+        # a map set on a permission instance isn't cached
+        permission = CachedPermissions()
+        permission.actions_to_perms_map = {'list': []}
+        self.assertEqual(permission.get_permissions_for_action('list', viewset(action='list')), [])
+        self.assertEqual(
+            CachedPermissions().get_permissions_for_action('list', viewset(action='list')),
+            ['viewset_permissions.view_ninjaturtlemodel'],
+        )
+
+    def test_list_actions_registry(self):
+        class Permissions(GenericDjangoViewsetPermissions):
+            actions_to_perms_map = {
+                'create': [],
+            }
+
+        class ListActionViewSet(viewsets.ModelViewSet):
+            queryset = NinjaTurtleModel.objects.all()
+            serializer_class = NinjaTurtleSerializer
+            permission_classes = [Permissions]
+
+            @action(detail=False)
+            def summary(self, request):
+                pass
+
+            @action(detail=True)
+            def shell(self, request, pk):
+                pass
+
+        class Router(ViewsetPermissionsRouterMixin, SimpleRouter):
+            pass
+
+        with patch.object(Permissions, '_find_list_actions', autospec=True, side_effect=Permissions._find_list_actions) as mock_find:
+            Router().register('turtles', ListActionViewSet)
+            self.assertEqual(mock_find.call_count, 1)
+
+            # already calculated
+            permission = Permissions()
+            self.assertEqual(permission.get_list_actions(ListActionViewSet()), {'list', 'create', 'summary'})
+            register_viewset_permissions(ListActionViewSet)
+            self.assertEqual(mock_find.call_count, 1)
+
+        self.assertEqual(permission.get_actions_to_perms_map()['create'], [])
+        self.assertEqual(
+            permission.get_actions_to_perms_map()['list'],
+            GenericDjangoViewsetPermissions.default_actions_to_perms_map['list'],
+        )
+        self.assertIs(Permissions().get_actions_to_perms_map(), permission.get_actions_to_perms_map())
 
+        # a map set on an instance isn't cached
+        permission.actions_to_perms_map = {'create': ['viewset_permissions.add_ninjaturtlemodel']}
+        self.assertEqual(permission.get_actions_to_perms_map()['create'], ['viewset_permissions.add_ninjaturtlemodel'])
+        self.assertEqual(Permissions().get_actions_to_perms_map()['create'], [])
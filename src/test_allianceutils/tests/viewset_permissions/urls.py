@@ -1,13 +1,22 @@
 from rest_framework.routers import DefaultRouter
 
+from allianceutils.api.routers import ViewsetPermissionsRouterMixin
+
+from .views import FilteredNinjaTurtleViewSet
 from .views import NinjaTurtleViewSet
 from .views import SimpleTestViewSet
 
 app_name = 'permissions'
 
-router = DefaultRouter(trailing_slash=True)
+
+class Router(ViewsetPermissionsRouterMixin, DefaultRouter):
+    pass
+
+
+router = Router(trailing_slash=True)
 router.include_format_suffixes = False
 router.register(r'turtle/simple', SimpleTestViewSet, basename='simple')
 router.register(r'turtle/model', NinjaTurtleViewSet, basename='model')
+router.register(r'turtle/filtered', FilteredNinjaTurtleViewSet, basename='filtered')
 
 urlpatterns = router.urls
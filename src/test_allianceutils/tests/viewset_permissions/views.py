@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from rest_framework import viewsets
 
+from allianceutils.api.mixins import PermissionQuerySetFilterMixin
 from allianceutils.api.permissions import GenericDjangoViewsetPermissions
 from allianceutils.api.permissions import SimpleDjangoObjectPermissions
 from test_allianceutils.tests.viewset_permissions.models import NinjaTurtleModel
@@ -27,3 +28,9 @@ class NinjaTurtleViewSet(viewsets.ModelViewSet):
 
     permission_classes = [GenericDjangoViewsetPermissions]
 
+
+class FilteredNinjaTurtleViewSet(PermissionQuerySetFilterMixin, viewsets.ModelViewSet):
+    queryset = NinjaTurtleModel.objects.order_by('pk')
+    serializer_class = NinjaTurtleSerializer
+
+    permission_classes = [GenericDjangoViewsetPermissions]